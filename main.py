@@ -1,19 +1,33 @@
-from flask import Flask, request, render_template_string, redirect, url_for, session, make_response, jsonify
+from flask import Flask, request, render_template, stream_template, send_file, redirect, url_for, session, make_response, jsonify
 import re
-import html
 import os
 import json
 import hashlib
+import secrets
 import time
 from datetime import datetime, timedelta
 from functools import wraps
+from contextlib import contextmanager
 import sqlite3
+import threading
+import queue
+from collections import OrderedDict
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from markupsafe import Markup, escape
+from jinja2 import DictLoader
 import urllib.parse
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# 模板都在代码里(DictLoader)，运行时不会变化，debug模式下也不必每次检查是否需要重新加载
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+# 部署在 Apache(mod_xsendfile)/lighttpd 之后时设置 TXPYWIKI_X_SENDFILE=1，
+# 上传文件改由前端服务器直接发送；没有前端服务器时开启会返回空文件
+app.config['USE_X_SENDFILE'] = os.environ.get('TXPYWIKI_X_SENDFILE') == '1'
+# 上传请求中除文件本身以外允许的额外字节数(multipart边界、表单头等)
+UPLOAD_OVERHEAD = 64 * 1024
 
 BASE_DIR = "wiki_data"
 PAGES_DIR = os.path.join(BASE_DIR, "pages")
@@ -37,181 +51,440 @@ DEFAULT_SETTINGS = {
     "site_description": "A TxPyWiki powered wiki"
 }
 
+SQLITE_PRAGMAS = '''
+PRAGMA journal_mode=WAL;
+PRAGMA busy_timeout=5000;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=memory;
+PRAGMA foreign_keys=ON;
+'''
+
+class Writer:
+    """唯一的写连接，由互斥锁保护"""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                     cached_statements=256)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SQLITE_PRAGMAS)
+        self._after_commit = []
+    
+    def after_commit(self, callback):
+        # 只能在事务内调用；提交成功后仍在锁内执行，回滚时丢弃
+        self._after_commit.append(callback)
+    
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE 一开始就拿到写锁，避免读锁中途升级
+        with self._lock:
+            self._after_commit = []
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn.cursor()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+                for callback in self._after_commit:
+                    callback()
+            finally:
+                self._after_commit = []
+
+class ReadPool:
+    """只读连接池，WAL模式下读操作可以与写连接并行"""
+    def __init__(self, path, size):
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(path)) + '?mode=ro'
+        self._queue = queue.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False,
+                                   cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            # journal_mode 由写连接设置，只读连接无法修改
+            conn.executescript(SQLITE_PRAGMAS.replace('PRAGMA journal_mode=WAL;', ''))
+            self._queue.put(conn)
+    
+    @contextmanager
+    def cursor(self):
+        conn = self._queue.get()
+        try:
+            yield conn.cursor()
+        finally:
+            self._queue.put(conn)
+
+writer = Writer(DB_PATH)
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  password_hash TEXT NOT NULL,
-                  email TEXT,
-                  is_admin INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS pages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  title TEXT UNIQUE NOT NULL,
-                  content TEXT,
-                  protection_level TEXT DEFAULT 'everyone',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  created_by INTEGER,
-                  updated_by INTEGER,
-                  FOREIGN KEY(created_by) REFERENCES users(id),
-                  FOREIGN KEY(updated_by) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS files
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  filename TEXT NOT NULL,
-                  original_name TEXT NOT NULL,
-                  filepath TEXT NOT NULL,
-                  size INTEGER NOT NULL,
-                  uploaded_by INTEGER,
-                  uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(uploaded_by) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS page_history
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  page_id INTEGER NOT NULL,
-                  content TEXT NOT NULL,
-                  edited_by INTEGER,
-                  edited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(page_id) REFERENCES pages(id),
-                  FOREIGN KEY(edited_by) REFERENCES users(id))''')
-    
-    conn.commit()
-    conn.close()
+    with writer.transaction() as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      username TEXT UNIQUE NOT NULL,
+                      password_hash TEXT NOT NULL,
+                      email TEXT,
+                      is_admin INTEGER DEFAULT 0,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+        c.execute('''CREATE TABLE IF NOT EXISTS pages
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      title TEXT UNIQUE NOT NULL,
+                      content TEXT,
+                      protection_level TEXT DEFAULT 'everyone',
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      created_by INTEGER,
+                      updated_by INTEGER,
+                      escaped_content TEXT,
+                      FOREIGN KEY(created_by) REFERENCES users(id),
+                      FOREIGN KEY(updated_by) REFERENCES users(id))''')
+        # 旧数据库没有 escaped_content 列，补上；旧页面在下次保存前该列为NULL
+        c.execute("PRAGMA table_info(pages)")
+        if 'escaped_content' not in [row['name'] for row in c.fetchall()]:
+            c.execute("ALTER TABLE pages ADD COLUMN escaped_content TEXT")
+    
+        c.execute('''CREATE TABLE IF NOT EXISTS files
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      filename TEXT NOT NULL,
+                      original_name TEXT NOT NULL,
+                      filepath TEXT NOT NULL,
+                      size INTEGER NOT NULL,
+                      uploaded_by INTEGER,
+                      uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY(uploaded_by) REFERENCES users(id))''')
+    
+        c.execute('''CREATE TABLE IF NOT EXISTS page_history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      page_id INTEGER NOT NULL,
+                      content TEXT NOT NULL,
+                      edited_by INTEGER,
+                      edited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY(page_id) REFERENCES pages(id),
+                      FOREIGN KEY(edited_by) REFERENCES users(id))''')
+    
+        c.execute("CREATE INDEX IF NOT EXISTS idx_hist_page ON page_history(page_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_pages_created ON pages(created_at)")
+    
+    init_search_index()
+
+# 标题搜索用的FTS5索引(trigram分词，支持中文标题的任意子串匹配)
+# 编译时没有FTS5或trigram的SQLite上退回 LIKE 全表扫描
+_HAS_FTS = False
+
+def init_search_index():
+    global _HAS_FTS
+    try:
+        with writer.transaction() as c:
+            c.execute("SELECT 1 FROM sqlite_master WHERE name = 'pages_fts'")
+            exists = c.fetchone() is not None
+            c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts
+                         USING fts5(title, content='pages', content_rowid='id', tokenize='trigram')''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS pages_fts_ai AFTER INSERT ON pages BEGIN
+                             INSERT INTO pages_fts(rowid, title) VALUES (new.id, new.title);
+                         END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS pages_fts_ad AFTER DELETE ON pages BEGIN
+                             INSERT INTO pages_fts(pages_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                         END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS pages_fts_au AFTER UPDATE OF title ON pages BEGIN
+                             INSERT INTO pages_fts(pages_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                             INSERT INTO pages_fts(rowid, title) VALUES (new.id, new.title);
+                         END''')
+            if not exists:
+                # 新建索引时把已有页面全部导入
+                c.execute("INSERT INTO pages_fts(pages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        return
+    _HAS_FTS = True
 
 init_db()
 
+read_pool = ReadPool(DB_PATH, os.cpu_count() or 4)
+
+# 设置文件解析结果缓存，文件修改时间变化后才重新解析
+_settings_cache = {'mtime': None, 'data': DEFAULT_SETTINGS}
+
 def get_settings():
-    if os.path.exists(SETTINGS_PATH):
-        try:
-            with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
-                content = f.read()
-                content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-                return {**DEFAULT_SETTINGS, **json.loads(content)}
-        except:
-            return DEFAULT_SETTINGS
-    return DEFAULT_SETTINGS
+    try:
+        mtime = os.stat(SETTINGS_PATH).st_mtime_ns
+    except OSError:
+        return DEFAULT_SETTINGS
+    if mtime == _settings_cache['mtime']:
+        return _settings_cache['data']
+    
+    try:
+        with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
+            content = f.read()
+            content = _RE_COMMENT.sub('', content)
+            settings = {**DEFAULT_SETTINGS, **json.loads(content)}
+    except:
+        settings = DEFAULT_SETTINGS
+    _settings_cache['mtime'], _settings_cache['data'] = mtime, settings
+    return settings
 
 def save_settings(settings):
     with open(SETTINGS_PATH, 'w', encoding='utf-8') as f:
         json.dump(settings, f, indent=2, ensure_ascii=False)
+    # 文件系统的时间精度可能较粗，保存后主动让缓存失效，不依赖mtime变化
+    _settings_cache['mtime'] = None
+
+def hash_password(password, salt=None):
+    # 存储格式: scrypt$盐$哈希
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+    return f'scrypt${salt.hex()}${digest.hex()}'
+
+def check_password(password_hash, password):
+    if password is None:
+        return False
+    if password_hash.startswith('scrypt$'):
+        _, salt, _ = password_hash.split('$')
+        return secrets.compare_digest(hash_password(password, bytes.fromhex(salt)), password_hash)
+    # 兼容旧版本的无盐SHA-256
+    return secrets.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# 热路径上的SQL都是固定的字符串常量，连接按语句文本复用已编译的语句
+_SQL_GET_USER = "SELECT id, username, password_hash, email, is_admin FROM users WHERE username = ?"
+_SQL_INSERT_USER = "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)"
+_SQL_GET_PAGE = '''SELECT id, title, content, protection_level, created_at, updated_at
+                   FROM pages WHERE title = ?'''
+_SQL_GET_PAGE_BY_ID = '''SELECT id, title, content, protection_level, created_at, updated_at
+                         FROM pages WHERE id = ?'''
+_SQL_GET_PROTECTION = "SELECT protection_level FROM pages WHERE title = ?"
+_SQL_GET_PAGE_ID = "SELECT id FROM pages WHERE title = ?"
+# escaped_content 保存HTML转义后的内容，编辑页直接放进textarea，不必每次打开都转义
+_SQL_GET_EDIT_CONTENT = "SELECT content, escaped_content FROM pages WHERE title = ?"
+_SQL_INSERT_PAGE = '''INSERT INTO pages (title, content, escaped_content, protection_level, created_by, updated_by)
+                      VALUES (?, ?, ?, ?, ?, ?)'''
+_SQL_UPDATE_PAGE = '''UPDATE pages SET content = ?, escaped_content = ?, updated_at = CURRENT_TIMESTAMP, updated_by = ?
+                      WHERE id = ?'''
+_SQL_INSERT_HISTORY = "INSERT INTO page_history (page_id, content, edited_by) VALUES (?, ?, ?)"
+_SQL_GET_STATS = '''SELECT (SELECT COUNT(*) FROM pages),
+                          (SELECT COUNT(*) FROM users),
+                          (SELECT COUNT(*) FROM page_history),
+                          (SELECT MIN(created_at) FROM pages)'''
+_SQL_SEARCH_FTS = "SELECT title FROM pages_fts WHERE pages_fts MATCH ? LIMIT 50"
+_SQL_SEARCH_LIKE = "SELECT title FROM pages WHERE title LIKE ? LIMIT 50"
 
 def get_user(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = c.fetchone()
-    conn.close()
-    return user
+    with read_pool.cursor() as c:
+        c.execute(_SQL_GET_USER, (username,))
+        return c.fetchone()
 
 def create_user(username, password, is_admin=False):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # 密码哈希计算较慢，放在事务之外，不占用写锁
+    password_hash = hash_password(password)
     try:
-        c.execute("INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
-                  (username, hash_password(password), 1 if is_admin else 0))
-        conn.commit()
+        with writer.transaction() as c:
+            c.execute(_SQL_INSERT_USER, (username, password_hash, 1 if is_admin else 0))
+            bump_stats(users=1)
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def get_page(title):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM pages WHERE title = ?", (title,))
-    page = c.fetchone()
-    conn.close()
-    return page
+    with read_pool.cursor() as c:
+        c.execute(_SQL_GET_PAGE, (title,))
+        return c.fetchone()
+
+def get_page_protection(title):
+    with read_pool.cursor() as c:
+        c.execute(_SQL_GET_PROTECTION, (title,))
+        row = c.fetchone()
+        return row['protection_level'] if row else None
+
+# 保护级别很少变化，编辑权限检查直接查这个缓存；新建、保护、移动、删除页面提交后清空
+# 查询在锁外进行，查询期间缓存被清空过(代数变化)的话结果可能已过期，不写入缓存
+_PROTECTION_CACHE_SIZE = 1024
+_protection_cache = {'gen': 0, 'levels': {}}
+_protection_lock = threading.Lock()
+
+def _protection_for(title):
+    with _protection_lock:
+        levels = _protection_cache['levels']
+        if title in levels:
+            return levels[title]
+        gen = _protection_cache['gen']
+    level = get_page_protection(title)
+    with _protection_lock:
+        if gen == _protection_cache['gen']:
+            levels = _protection_cache['levels']
+            if len(levels) >= _PROTECTION_CACHE_SIZE:
+                levels.clear()
+            levels[title] = level
+    return level
+
+def invalidate_protection():
+    with _protection_lock:
+        _protection_cache['gen'] += 1
+        _protection_cache['levels'] = {}
+
+def get_edit_content(title):
+    """返回编辑框使用的已转义内容"""
+    with read_pool.cursor() as c:
+        c.execute(_SQL_GET_EDIT_CONTENT, (title,))
+        row = c.fetchone()
+    if row is None:
+        return Markup('')
+    if row['escaped_content'] is None:
+        return Markup(escape_html(row['content'] or ''))
+    return Markup(row['escaped_content'])
 
 def get_page_by_id(page_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM pages WHERE id = ?", (page_id,))
-    page = c.fetchone()
-    conn.close()
-    return page
-
-def create_page(title, content, user_id=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        settings = get_settings()
-        c.execute('''INSERT INTO pages 
-                     (title, content, protection_level, created_by, updated_by) 
+    with read_pool.cursor() as c:
+        c.execute(_SQL_GET_PAGE_BY_ID, (page_id,))
+        return c.fetchone()
+
+def create_pages(pages, user_id=None):
+    """批量创建页面 {标题: 内容}，全部在一个事务中提交；已存在的页面跳过"""
+    # 读取设置文件和转义内容放在事务之外，写锁只覆盖INSERT
+    settings = get_settings()
+    escaped = {title: escape_html(content) for title, content in pages.items()}
+    created = {}
+    with writer.transaction() as c:
+        for title, content in pages.items():
+            try:
+                c.execute(_SQL_INSERT_PAGE, (title, content, escaped[title], settings['default_protection'], user_id, user_id))
+            except sqlite3.IntegrityError:
+                # 冲突只回滚这一条语句，事务中其他页面不受影响
+                continue
+            created[title] = c.lastrowid
+            c.execute(_SQL_INSERT_HISTORY, (created[title], content, user_id))
+            bump_stats(pages=1, edits=1)
+    invalidate_protection()
+    # 保存时就渲染一次放入缓存，浏览时不再经过解析器
+    for title in created:
+        render_page(pages[title], title)
+    return created
+
+def save_page(title, content, user_id=None):
+    """页面存在则更新，不存在则创建；查找、写入和历史记录在同一个事务中提交"""
+    settings = get_settings()
+    escaped = escape_html(content)
+    with writer.transaction() as c:
+        c.execute(_SQL_GET_PAGE_ID, (title,))
+        page = c.fetchone()
+        if page:
+            page_id = page['id']
+            c.execute(_SQL_UPDATE_PAGE, (content, escaped, user_id, page_id))
+            bump_stats(edits=1)
+        else:
+            c.execute(_SQL_INSERT_PAGE,
+                      (title, content, escaped, settings['default_protection'], user_id, user_id))
+            page_id = c.lastrowid
+            bump_stats(pages=1, edits=1)
+        c.execute(_SQL_INSERT_HISTORY, (page_id, content, user_id))
+    if not page:
+        invalidate_protection()
+    render_page(content, title)
+    return page_id
+
+def set_page_protection(title, level):
+    with writer.transaction() as c:
+        c.execute("UPDATE pages SET protection_level = ? WHERE title = ?", (level, title))
+    invalidate_protection()
+
+def move_page(title, new_title):
+    with writer.transaction() as c:
+        c.execute("UPDATE pages SET title = ? WHERE title = ?", (new_title, title))
+    invalidate_protection()
+
+def delete_page(title):
+    with writer.transaction() as c:
+        # 开启了外键约束，先删除该页面的历史记录
+        c.execute("DELETE FROM page_history WHERE page_id IN (SELECT id FROM pages WHERE title = ?)", (title,))
+        c.execute("DELETE FROM pages WHERE title = ?", (title,))
+    invalidate_protection()
+    invalidate_stats()
+
+def add_file(filename, original_name, filepath, size, user_id):
+    with writer.transaction() as c:
+        c.execute('''INSERT INTO files (filename, original_name, filepath, size, uploaded_by)
                      VALUES (?, ?, ?, ?, ?)''',
-                  (title, content, settings['default_protection'], user_id, user_id))
-        page_id = c.lastrowid
-        c.execute("INSERT INTO page_history (page_id, content, edited_by) VALUES (?, ?, ?)",
-                  (page_id, content, user_id))
-        conn.commit()
-        return page_id
-    except sqlite3.IntegrityError:
-        return None
-    finally:
-        conn.close()
+                  (filename, original_name, filepath, size, user_id))
 
-def update_page(title, content, user_id=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id FROM pages WHERE title = ?", (title,))
-    page = c.fetchone()
-    if page:
-        page_id = page[0]
-        c.execute('''UPDATE pages SET content = ?, updated_at = CURRENT_TIMESTAMP, 
-                     updated_by = ? WHERE id = ?''',
-                  (content, user_id, page_id))
-        c.execute("INSERT INTO page_history (page_id, content, edited_by) VALUES (?, ?, ?)",
-                  (page_id, content, user_id))
-        conn.commit()
-        return True
-    return False
+# 统计数字启动后只查询一次，之后由各个写操作直接增减
+# 页脚的统计HTML也随之缓存，数字变化时才重新生成
+_stats_cache = {'data': None, 'footer': None}
 
 def get_stats():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute("SELECT COUNT(*) FROM pages")
-    page_count = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM users")
-    user_count = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM page_history")
-    edit_count = c.fetchone()[0]
-    
-    c.execute("SELECT MIN(created_at) FROM pages")
-    first_page = c.fetchone()[0]
-    
-    conn.close()
-    
-    return {
-        "pages": page_count,
-        "users": user_count,
-        "edits": edit_count,
-        "first_edit": first_page
-    }
+    stats = _stats_cache['data']
+    if stats is not None:
+        return stats
+    
+    # 在写锁内重新查询：查询期间不会有写事务提交，也不会有 bump_stats 的增减被漏掉
+    # 四项统计合并成一条语句，一次往返取回
+    with writer.transaction() as c:
+        stats = _stats_cache['data']
+        if stats is not None:
+            return stats
+        c.execute(_SQL_GET_STATS)
+        stats = dict(zip(("pages", "users", "edits", "first_edit"), c.fetchone()))
+        _stats_cache['data'] = stats
+    return stats
 
-def can_edit_page(page_title, user=None):
-    page = get_page(page_title)
-    if not page:
+def bump_stats(**deltas):
+    # 必须在写事务内调用；增减在提交成功后才生效，事务回滚时计数不变
+    writer.after_commit(lambda: _apply_stats_deltas(deltas))
+
+def _apply_stats_deltas(deltas):
+    # 在写锁内执行，增减不会相互覆盖
+    stats = _stats_cache['data']
+    if stats is None or (deltas.get('pages') and stats['first_edit'] is None):
+        # 还没加载过，或者第一个页面的创建时间需要重新查询
+        invalidate_stats()
+        return
+    stats = dict(stats)
+    for key, delta in deltas.items():
+        stats[key] += delta
+    _stats_cache['data'], _stats_cache['footer'] = stats, None
+
+def invalidate_stats():
+    _stats_cache['data'] = _stats_cache['footer'] = None
+
+def get_stats_footer():
+    footer = _stats_cache['footer']
+    if footer is None:
+        stats = get_stats()
+        items = (
+            (stats["pages"], '页面'),
+            (stats["users"], '用户'),
+            (stats["edits"], '编辑'),
+            (stats["first_edit"][:10] if stats["first_edit"] else "N/A", '始于'),
+        )
+        footer = Markup(''.join(
+            f'''
+                            <div class="stat-item">
+                                <span class="stat-value">{escape_html(str(value))}</span>
+                                <span class="stat-label">{label}</span>
+                            </div>'''
+            for value, label in items))
+        _stats_cache['footer'] = footer
+    return footer
+
+# markupsafe 的转义由C扩展实现，比 html.escape 快
+# 转回普通str，避免结果与字符串拼接时被Markup再次转义
+def escape_html(text):
+    return str(escape(text))
+
+# 常见的页面标题只含这些字符，urllib.parse.quote 对它们不做任何改动
+_RE_URL_SAFE = re.compile(r'[A-Za-z0-9_.~/-]*')
+
+def fast_quote(text):
+    if _RE_URL_SAFE.fullmatch(text):
+        return text
+    return urllib.parse.quote(text)
+
+def can_edit_page(page_title, logged_in=False, is_admin=False):
+    protection = _protection_for(page_title)
+    if protection is None:
         return True
     
-    protection = page[3]
     if protection == 'everyone':
         return True
     elif protection == 'loggedin':
-        return user is not None
+        return logged_in
     elif protection == 'admin':
-        return user and user[4] == 1
+        return is_admin
     return False
 
 def login_required(f):
@@ -227,96 +500,144 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return redirect(url_for('login', next=request.url))
-        user = get_user(session.get('username'))
-        if not user or user[4] != 1:
+        # 管理员标记在登录时写入会话，不必每次请求都查询用户表
+        if session.get('is_admin') != 1:
             return "需要管理员权限", 403
         return f(*args, **kwargs)
     return decorated_function
 
-class TxPyWikiParser:
-    def __init__(self):
-        self.current_page = ""
-        self.templates = self.load_templates()
-    
-    def load_templates(self):
-        templates = {}
+_RE_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+# parse_inline 的所有行内语法合并为一个正则，一次扫描完成全部替换
+# /* */ 注释已在 parse_to_html 中统一去除，这里不再处理
+# 同一位置按列表顺序优先匹配，(github:...) 和 (ghp:...) 必须排在普通页面链接之前
+_INLINE_PATTERNS = [
+    ('plantext', r'<plantext>(?P<plantext_body>(?s:.*?))</plantext>'),
+    ('redirect', r'\[\[\[RD\s+(?P<redirect_target>.+?)\]\]\]'),
+    ('github', r'\(github:(?P<github_body>[^)]+)\)'),
+    ('ghp', r'\(ghp:(?P<ghp_body>[^)]+)\)'),
+    ('pagelink', r'\((?P<pagelink_body>[^)]+)\)'),
+    ('extlink', r'\{\{(?P<extlink_body>[^}]+)\}\}'),
+    ('sup', r'<up>(?P<sup_body>.*?)</up>'),
+    ('sub', r'<dn>(?P<sub_body>.*?)</dn>'),
+]
+_RE_INLINE = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in _INLINE_PATTERNS))
+# HTML转义后的文本里，只有含这些字符时才可能匹配行内语法
+_INLINE_MARKERS = frozenset('([{')
+_RE_HEADER_TEMPLATE = re.compile(r'\[(\w+)')
+# parse_special_tags 的特殊标签同样合并为一个正则，整篇文档只扫描一遍
+# 标签可以跨行（<script>、<co>、<doc>等），所以仍然对拼接后的全文处理，而不是逐行处理
+_SPECIAL_PATTERNS = [
+    ('style', r'<style>(?P<style_body>(?s:.*?))</style>'),
+    ('script', r'<script>(?P<script_body>(?s:.*?))</script>'),
+    ('iframe', r'<iframe src="(?P<iframe_src>[^"]+)">(?s:.*?)</iframe>'),
+    ('img', r'<img src="(?P<img_src>[^"]+)">(?s:.*?)</img>'),
+    ('button', r'<button(?P<button_attrs>.*?)\s*"touchEvent"="(?P<button_event>[^"]*)"[^>]*>(?P<button_text>.*?)</button>'),
+    ('code', r'<code lang="(?P<code_lang>[^"]*)">(?P<code_body>(?s:.*?))</code>'),
+    ('co', r'<co>(?P<co_body>(?s:.*?))</co>'),
+    ('mw', r'<mw>(?P<mw_body>(?s:.*?))</mw>'),
+    ('doc', r'<doc>(?s:.*?)</doc>'),
+]
+_RE_SPECIAL = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in _SPECIAL_PATTERNS))
+_RE_BUTTON_STYLE = re.compile(r'style="([^"]*)"')
+
+def _split_link(content):
+    if '\\\\' in content:  # 表格中使用\\分隔
+        return content.split('\\\\', 1)
+    elif '\\' in content:  # 正常链接中使用\分隔
+        return content.split('\\', 1)
+    return content, None
+
+# 模板文件名 TEMPLATE.<模板名>.3p，模板名取到第一个点为止
+_RE_TEMPLATE_FILE = re.compile(r'TEMPLATE\.([^.]*)')
+
+# 模板文件缓存 {文件名: (mtime, 内容)}，只有修改时间变化的文件才重新读取
+_TEMPLATE_CACHE = {}
+# 任一模板文件被重新读取或删除时递增
+_template_version = 0
+# 多个请求线程可能同时刷新模板缓存
+_template_lock = threading.Lock()
+
+def load_templates():
+    """返回 ({模板名: 内容}, 模板版本)"""
+    global _template_version
+    templates = {}
+    seen = set()
+    with _template_lock:
         if os.path.exists(PAGES_DIR):
-            for filename in os.listdir(PAGES_DIR):
-                if filename.startswith("TEMPLATE."):
-                    template_name = filename[9:]
-                    if '.' in template_name:
-                        template_name = template_name.split('.')[0]
+            with os.scandir(PAGES_DIR) as it:
+                for entry in it:
+                    m = _RE_TEMPLATE_FILE.match(entry.name)
+                    if not m:
+                        continue
+                    template_name = m.group(1)
                     try:
-                        with open(os.path.join(PAGES_DIR, filename), 'r', encoding='utf-8') as f:
-                            templates[template_name] = f.read()
+                        mtime = entry.stat().st_mtime_ns
+                        cached = _TEMPLATE_CACHE.get(entry.name)
+                        if cached is None or cached[0] != mtime:
+                            with open(entry.path, 'r', encoding='utf-8') as f:
+                                cached = (mtime, f.read())
+                            _TEMPLATE_CACHE[entry.name] = cached
+                            _template_version += 1
+                        templates[template_name] = cached[1]
+                        seen.add(entry.name)
                     except:
                         pass
-        return templates
+        for filename in set(_TEMPLATE_CACHE) - seen:
+            del _TEMPLATE_CACHE[filename]
+            _template_version += 1
+        return templates, _template_version
+
+class TxPyWikiParser:
+    # 解析状态(当前页面、是否用到<time>/模板)保存在实例上，每次渲染使用新的实例，不在线程间共享
+    def __init__(self):
+        self.current_page = ""
+        self.uses_time = False
+        self.now = None
+        self.uses_templates = False
+        # 模板在第一次用到时才加载
+        self.templates = {}
+        self.template_version = None
     
     def parse_headers(self, line):
-        if line.startswith('+'):
-            level = line.count('+')
-            text = line.lstrip('+').strip()
-            if 1 <= level <= 4:
-                return f'<h{level}>{self.parse_inline(text)}</h{level}>'
+        # 只数行首连续的+，标题正文里的+不影响级别
+        level = 0
+        n = len(line)
+        while level < n and line[level] == '+':
+            level += 1
+        if 1 <= level <= 4:
+            return f'<h{level}>{self.parse_inline(line[level:].strip())}</h{level}>'
         return None
     
     def parse_inline(self, text):
-        # 首先处理<plantext>标签，内部内容不解析
-        def plantext_repl(match):
-            content = match.group(1)
-            # 只进行HTML转义，不进行任何其他解析
-            return html.escape(content)
-        
-        # 先提取所有<plantext>标签的内容
-        plantext_pattern = r'<plantext>(.*?)</plantext>'
-        plantext_matches = list(re.finditer(plantext_pattern, text, re.DOTALL))
-        
-        # 如果有<plantext>标签，先替换为占位符
-        if plantext_matches:
-            plantext_contents = []
-            for i, match in enumerate(plantext_matches):
-                plantext_contents.append(match.group(1))
-                text = text.replace(match.group(0), f'__PLANTEXT_{i}__', 1)
+        text = _RE_INLINE.sub(self._inline_repl, text)
         
-        # 正常的解析处理
-        text = text.replace('<br>', '<br>')
-        text = re.sub(r'<small>(.*?)</small>', r'<small>\1</small>', text)
-        text = re.sub(r'<big>(.*?)</big>', r'<big>\1</big>', text)
+        if '<pagename>' in text:
+            text = text.replace('<pagename>', self.current_page)
+        if '<time>' in text:
+            self.uses_time = True
+            # 同一次渲染中的所有<time>使用同一个时间，只格式化一次
+            if self.now is None:
+                self.now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            text = text.replace('<time>', self.now)
         
-        text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
-        
-        # 处理重定向 [[[RD 目标页面]]]
-        def redirect_repl(match):
-            target = match.group(1).strip()
+        return text
+    
+    def _inline_repl(self, match):
+        kind = match.lastgroup
+        if kind == 'plantext':
+            # <plantext>内部内容只进行HTML转义，不进行任何其他解析
+            return escape_html(match.group('plantext_body'))
+        elif kind == 'redirect':
+            # 处理重定向 [[[RD 目标页面]]]
+            target = match.group('redirect_target').strip()
             return f'<script>window.location.href = "/wiki/{target}";</script><p>正在重定向到: <a href="/wiki/{target}">{target}</a></p>'
-        text = re.sub(r'\[\[\[RD\s+(.+?)\]\]\]', redirect_repl, text)
-        
-        def page_link_repl(match):
-            page = match.group(1)
-            if '\\\\' in page:  # 表格中使用\\分隔
-                page, display = page.split('\\\\', 1)
-                return f'<a href="/wiki/{page}">{display}</a>'
-            elif '\\' in page:  # 正常链接中使用\分隔
-                page, display = page.split('\\', 1)
-                return f'<a href="/wiki/{page}">{display}</a>'
-            return f'<a href="/wiki/{page}">{page}</a>'
-        text = re.sub(r'\(([^)]+)\)', page_link_repl, text)
-        
-        def github_link_repl(match):
-            content = match.group(1)
-            if '\\\\' in content:  # 表格中使用\\分隔
-                repo, display = content.split('\\\\', 1)
-                return f'<a href="https://github.com/{repo}" target="_blank">{display}</a>'
-            elif '\\' in content:  # 正常链接中使用\分隔
-                repo, display = content.split('\\', 1)
-                return f'<a href="https://github.com/{repo}" target="_blank">{display}</a>'
-            return f'<a href="https://github.com/{content}" target="_blank">{content}</a>'
-        text = re.sub(r'\(github:([^)]+)\)', github_link_repl, text)
-        
-        def ghp_repl(match):
+        elif kind == 'github':
+            repo, display = _split_link(match.group('github_body'))
+            display = repo if display is None else _RE_INLINE.sub(self._inline_repl, display)
+            return f'<a href="https://github.com/{repo}" target="_blank">{display}</a>'
+        elif kind == 'ghp':
             try:
-                user, page = match.group(1).split(':')
+                user, page = match.group('ghp_body').split(':')
                 return f'''
                 <div class="ghp-container">
                     <iframe src="https://{user}.github.io/{page}" 
@@ -327,80 +648,78 @@ class TxPyWikiParser:
                 </div>
                 '''
             except:
-                return f'[GitHub Pages嵌入错误: {match.group(1)}]'
-        text = re.sub(r'\(ghp:([^)]+)\)', ghp_repl, text)
-        
-        def ext_link_repl(match):
-            content = match.group(1)
-            if '\\\\' in content:  # 表格中使用\\分隔
-                url, display = content.split('\\\\', 1)
-                if not url.startswith(('http://', 'https://')):
-                    url = 'https://' + url
-                return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{display}</a>'
-            elif '\\' in content:  # 正常链接中使用\分隔
-                url, display = content.split('\\', 1)
-                if not url.startswith(('http://', 'https://')):
-                    url = 'https://' + url
-                return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{display}</a>'
-            else:
-                if not content.startswith(('http://', 'https://')):
-                    content = 'https://' + content
-                return f'<a href="{content}" target="_blank" rel="noopener noreferrer">{content}</a>'
-        text = re.sub(r'\{\{([^}]+)\}\}', ext_link_repl, text)
-        
-        text = re.sub(r'<up>(.*?)</up>', r'<sup>\1</sup>', text)
-        text = re.sub(r'<dn>(.*?)</dn>', r'<sub>\1</sub>', text)
-        
-        text = text.replace('<pagename>', self.current_page)
-        text = text.replace('<time>', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        
-        # 恢复<plantext>内容（只进行HTML转义）
-        if plantext_matches:
-            for i, content in enumerate(plantext_contents):
-                escaped_content = html.escape(content)
-                text = text.replace(f'__PLANTEXT_{i}__', escaped_content)
-        
-        return text
+                return f'[GitHub Pages嵌入错误: {match.group("ghp_body")}]'
+        elif kind == 'pagelink':
+            page, display = _split_link(match.group('pagelink_body'))
+            display = _RE_INLINE.sub(self._inline_repl, page if display is None else display)
+            return f'<a href="/wiki/{page}">{display}</a>'
+        elif kind == 'extlink':
+            url, display = _split_link(match.group('extlink_body'))
+            if not url.startswith(('http://', 'https://')):
+                url = 'https://' + url
+            display = url if display is None else _RE_INLINE.sub(self._inline_repl, display)
+            return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{display}</a>'
+        elif kind == 'sup':
+            return f'<sup>{_RE_INLINE.sub(self._inline_repl, match.group("sup_body"))}</sup>'
+        elif kind == 'sub':
+            return f'<sub>{_RE_INLINE.sub(self._inline_repl, match.group("sub_body"))}</sub>'
     
     def parse_template(self, lines, start_idx):
         line = lines[start_idx]
-        if line.startswith('[') and not line.startswith('[['):
-            template_end = start_idx
-            for i in range(start_idx, len(lines)):
-                if lines[i].strip() == ']':
-                    template_end = i
-                    break
-            
-            template_lines = lines[start_idx:template_end + 1]
-            template_content = '\n'.join(template_lines)
-            
-            match = re.match(r'\[(\w+)(.*?)\]', template_content, re.DOTALL)
-            if match:
-                template_name = match.group(1)
-                params_text = match.group(2).strip()
-                
-                params = {}
-                lines_params = params_text.split('\n')
-                for param_line in lines_params:
-                    if '=' in param_line:
-                        key, value = param_line.split('=', 1)
-                        params[key.strip()] = value.strip()
-                    elif param_line and '\\\\' in param_line:
-                        params['_table_data'] = params.get('_table_data', [])
-                        params['_table_data'].append(param_line.split('\\\\'))
-                
-                if template_name == 'table':
-                    return self.generate_table(params), template_end
-                elif template_name == 'navbox':
-                    return self.generate_navbox(params), template_end
-                elif template_name == 'file':
-                    return self.handle_file(params), template_end
-                elif template_name in self.templates:
+        if not line.startswith('[') or line.startswith('[['):
+            return None, start_idx
+        
+        # 单次扫描：首行取模板名，之后逐行收集参数，参数到第一个 ] 为止，
+        # 模板在只有 ] 的行结束；找不到结束行时只解析首行
+        match = _RE_HEADER_TEMPLATE.match(line)
+        params = {}
+        closed = False
+        found_end = False
+        template_end = start_idx
+        for i in range(start_idx, len(lines)):
+            param_line = lines[i]
+            if param_line.strip() == ']':
+                template_end = i
+                closed = found_end = True
+                break
+            if match is None or closed:
+                continue
+            self._add_template_param(params, param_line[match.end():] if i == start_idx else param_line)
+            closed = ']' in param_line
+        
+        if match and not found_end:
+            # 没有结束行：参数只来自首行，首行内有 ] 才算完整的模板
+            params = {}
+            self._add_template_param(params, line[match.end():])
+            closed = ']' in line[match.end():]
+        
+        if match and closed:
+            template_name = match.group(1)
+            if template_name == 'table':
+                return self.generate_table(params), template_end
+            elif template_name == 'navbox':
+                return self.generate_navbox(params), template_end
+            elif template_name == 'file':
+                return self.handle_file(params), template_end
+            else:
+                # 自定义模板按需刷新，未修改的模板文件直接使用缓存
+                # 一次渲染只加载一次，同一页面里的模板来自同一个版本
+                self.uses_templates = True
+                if self.template_version is None:
+                    self.templates, self.template_version = load_templates()
+                if template_name in self.templates:
                     return self.process_custom_template(template_name, params), template_end
-            
-            return template_content, template_end
         
-        return None, start_idx
+        return '\n'.join(lines[start_idx:template_end + 1]), template_end
+    
+    def _add_template_param(self, params, param_line):
+        # 参数行在第一个 ] 处截断
+        param_line = param_line.split(']', 1)[0].strip()
+        if '=' in param_line:
+            key, value = param_line.split('=', 1)
+            params[key.strip()] = value.strip()
+        elif param_line and '\\\\' in param_line:
+            params.setdefault('_table_data', []).append(param_line.split('\\\\'))
     
     def handle_file(self, params):
         if 'name' in params:
@@ -416,69 +735,71 @@ class TxPyWikiParser:
         if not data:
             return ''
         
-        html_output = '<div class="wiki-table">'
+        parts = ['<div class="wiki-table">']
         if 'name' in params:
-            html_output += f'<h4>{html.escape(params["name"])}</h4>'
+            parts.append(f'<h4>{escape_html(params["name"])}</h4>')
         
-        html_output += '<table>'
+        parts.append('<table>')
         
         headers = data[0]
-        html_output += '<thead><tr>'
-        for header in headers:
-            html_output += f'<th>{html.escape(header)}</th>'
-        html_output += '</tr></thead>'
+        parts.append('<thead><tr>')
+        parts.extend([f'<th>{escape_html(header)}</th>' for header in headers])
+        parts.append('</tr></thead>')
         
-        html_output += '<tbody>'
+        parts.append('<tbody>')
         for row in data[1:]:
-            html_output += '<tr>'
+            cells = []
             for cell in row:
-                html_output += f'<td>{self.parse_inline(html.escape(cell))}</td>'
-            html_output += '</tr>'
-        html_output += '</tbody>'
+                cell = escape_html(cell)
+                if not _INLINE_MARKERS.isdisjoint(cell):
+                    cell = self.parse_inline(cell)
+                cells.append(f'<td>{cell}</td>')
+            parts.append(f'<tr>{"".join(cells)}</tr>')
+        parts.append('</tbody>')
         
-        html_output += '</table></div>'
-        return html_output
+        parts.append('</table></div>')
+        return ''.join(parts)
     
     def generate_navbox(self, params):
-        html_output = f'''
+        parts = [f'''
         <div class="navbox">
             <div class="navbox-title" style="background:{params.get('color', '#cfe3ff')}">
                 <span>{params.get('name', '导航')}</span>
             </div>
-        '''
+        ''']
         
         for i in range(1, 11):
             group_key = f'g{i}'
             list_key = f'l{i}'
             
             if group_key in params:
-                html_output += f'''
+                parts.append(f'''
                 <div class="navbox-group">
                     <div class="navbox-group-title" style="background:{params.get('color2', '#e8f2ff')}">
                         {params[group_key]}
                     </div>
                     <div class="navbox-content">
                         {self.parse_inline(params.get(list_key, ""))}
-                '''
+                ''')
                 
                 for j in range(1, 3):
                     sub_group_key = f'g{i}.{j}'
                     sub_list_key = f'l{i}.{j}'
                     
                     if sub_group_key in params:
-                        html_output += f'''
+                        parts.append(f'''
                         <div class="navbox-subgroup">
                             <div class="navbox-subgroup-title">{params[sub_group_key]}</div>
                             <div class="navbox-subgroup-content">
                                 {self.parse_inline(params.get(sub_list_key, ""))}
                             </div>
                         </div>
-                        '''
+                        ''')
                 
-                html_output += '</div></div>'
+                parts.append('</div></div>')
         
-        html_output += '</div>'
-        return html_output
+        parts.append('</div>')
+        return ''.join(parts)
     
     def process_custom_template(self, template_name, params):
         if template_name not in self.templates:
@@ -496,27 +817,29 @@ class TxPyWikiParser:
         return self.parse_to_html(template_content, self.current_page)
     
     def parse_special_tags(self, text):
-        def style_repl(match):
-            return f'<style>{match.group(1)}</style>'
-        text = re.sub(r'<style>(.*?)</style>', style_repl, text, flags=re.DOTALL)
-        
-        def script_repl(match):
-            script_content = match.group(1)
+        if '<' not in text:
+            return text
+        return _RE_SPECIAL.sub(self._special_repl, text)
+    
+    def _special_repl(self, match):
+        kind = match.lastgroup
+        if kind == 'style':
+            return f'<style>{match.group("style_body")}</style>'
+        elif kind == 'script':
+            script_content = match.group('script_body')
             return f'''
             <div class="script-container">
                 <button class="script-run-btn" onclick="runScript(this)">运行脚本</button>
                 <div class="script-output" style="display:none;">
                     <iframe sandbox="allow-scripts" 
-                            srcdoc="<!DOCTYPE html><html><head><script>{html.escape(script_content)}</script></head><body></body></html>"
+                            srcdoc="<!DOCTYPE html><html><head><script>{escape_html(script_content)}</script></head><body></body></html>"
                             width="100%" 
                             height="200"></iframe>
                 </div>
             </div>
             '''
-        text = re.sub(r'<script>(.*?)</script>', script_repl, text, flags=re.DOTALL)
-        
-        def iframe_repl(match):
-            src = match.group(1)
+        elif kind == 'iframe':
+            src = match.group('iframe_src')
             return f'''
             <div class="iframe-container">
                 <iframe src="{src}" 
@@ -526,69 +849,44 @@ class TxPyWikiParser:
                         allowfullscreen></iframe>
             </div>
             '''
-        text = re.sub(r'<iframe src="([^"]+)">.*?</iframe>', iframe_repl, text, flags=re.DOTALL)
-        
-        def img_repl(match):
-            src = match.group(1)
-            return f'<img src="{src}" class="wiki-image">'
-        text = re.sub(r'<img src="([^"]+)">.*?</img>', img_repl, text, flags=re.DOTALL)
-        
-        def button_repl(match):
-            button_text = match.group(3)
-            attrs = match.group(1) or ''
-            touch_event = match.group(2) or ''
+        elif kind == 'img':
+            return f'<img src="{match.group("img_src")}" class="wiki-image">'
+        elif kind == 'button':
+            button_text = match.group('button_text')
+            attrs = match.group('button_attrs') or ''
+            touch_event = match.group('button_event') or ''
             
-            style_match = re.search(r'style="([^"]*)"', attrs)
+            style_match = _RE_BUTTON_STYLE.search(attrs)
             style = style_match.group(1) if style_match else ''
             
-            button_id = f'btn_{hash(button_text + touch_event) % 10000}'
-            return f'''
-            <button id="{button_id}" class="wiki-button" style="{style}">{button_text}</button>
-            <script>
-                document.getElementById('{button_id}').addEventListener('click', function() {{
-                    var output = document.createElement('div');
-                    output.className = 'button-output';
-                    output.innerHTML = `{self.parse_inline(touch_event)}`;
-                    this.parentNode.insertBefore(output, this.nextSibling);
-                }});
-            </script>
-            '''
-        text = re.sub(r'<button(.*?)\s*"touchEvent"="([^"]*)"[^>]*>(.*?)</button>', button_repl, text)
-        
-        def code_repl(match):
-            lang = match.group(1) or ''
-            code_content = match.group(2)
-            escaped_code = html.escape(code_content)
+            # 点击事件由 BASE_JS 中的全局监听器统一处理，这里只输出解析后的内容
+            touch_html = escape_html(self.parse_inline(touch_event))
+            return f'<button class="wiki-button" data-touch-event="{touch_html}" style="{style}">{button_text}</button>'
+        elif kind == 'code':
+            lang = match.group('code_lang') or ''
+            escaped_code = escape_html(match.group('code_body'))
             return f'<pre><code class="language-{lang}">{escaped_code}</code></pre>'
-        text = re.sub(r'<code lang="([^"]*)">(.*?)</code>', code_repl, text, flags=re.DOTALL)
-        
-        def co_repl(match):
-            content = match.group(1)
-            co_id = f'co_{hash(content) % 10000}'
+        elif kind == 'co':
+            content = match.group('co_body')
+            # 折叠块内部可能嵌套其他特殊标签，递归处理
             return f'''
             <div class="collapsible">
-                <button class="collapsible-btn" onclick="toggleCollapse('{co_id}')">显示/隐藏内容</button>
-                <div id="{co_id}" class="collapsible-content">
-                    {self.parse_inline(content)}
+                <button class="collapsible-btn">显示/隐藏内容</button>
+                <div class="collapsible-content">
+                    {self.parse_inline(self.parse_special_tags(content))}
                 </div>
             </div>
             '''
-        text = re.sub(r'<co>(.*?)</co>', co_repl, text, flags=re.DOTALL)
-        
-        def mw_repl(match):
-            mw_content = match.group(1)
-            return f'<div class="mw-content">{html.escape(mw_content)}</div>'
-        text = re.sub(r'<mw>(.*?)</mw>', mw_repl, text, flags=re.DOTALL)
-        
-        text = re.sub(r'<doc>.*?</doc>', '', text, flags=re.DOTALL)
-        
-        return text
+        elif kind == 'mw':
+            return f'<div class="mw-content">{escape_html(match.group("mw_body"))}</div>'
+        elif kind == 'doc':
+            return ''
     
     def parse_to_html(self, text, page_name=""):
         self.current_page = page_name
-        self.templates = self.load_templates()
+        self.now = None
         
-        text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+        text = _RE_COMMENT.sub('', text)
         
         lines = text.split('\n')
         html_output = []
@@ -618,15 +916,44 @@ class TxPyWikiParser:
             html_output.append(f'<p>{parsed_line}</p>')
             i += 1
         
-        full_html = '\n'.join(html_output)
-        full_html = self.parse_special_tags(full_html)
-        
-        return full_html
+        return self.parse_special_tags('\n'.join(html_output))
 
-parser = TxPyWikiParser()
+# 渲染结果缓存 {(页面名, 内容哈希): (html, 模板版本)}，按LRU淘汰
+# 含<time>的页面每次结果都不同，不缓存；用到自定义模板的页面在模板变化后失效
+_RENDER_CACHE = OrderedDict()
+_RENDER_CACHE_SIZE = 512
+_render_lock = threading.Lock()
 
-BASE_CSS = '''
-<style>
+def render_page(text, page_name=""):
+    """返回 (html, 是否可缓存)，含<time>的页面每次渲染结果不同，不可缓存"""
+    key = (page_name, hashlib.blake2b(text.encode(), digest_size=8).hexdigest())
+    with _render_lock:
+        cached = _RENDER_CACHE.get(key)
+        if cached is not None:
+            _RENDER_CACHE.move_to_end(key)
+    
+    if cached is not None:
+        html_content, template_version = cached
+        if template_version is None:
+            return html_content, True
+        if template_version == load_templates()[1]:
+            return html_content, True
+    
+    parser = TxPyWikiParser()
+    html_content = parser.parse_to_html(text, page_name)
+    
+    if not parser.uses_time:
+        # 记录解析时读到的模板版本，之后模板被修改的话下次会重新渲染
+        entry = (html_content, parser.template_version if parser.uses_templates else None)
+        with _render_lock:
+            _RENDER_CACHE[key] = entry
+            _RENDER_CACHE.move_to_end(key)
+            while len(_RENDER_CACHE) > _RENDER_CACHE_SIZE:
+                _RENDER_CACHE.popitem(last=False)
+    
+    return html_content, not parser.uses_time
+
+BASE_CSS_SOURCE = '''
 * {
     margin: 0;
     padding: 0;
@@ -1087,19 +1414,9 @@ body {
         border-bottom: 1px solid #a2a9b1;
     }
 }
-</style>
 '''
 
-BASE_JS = '''
-<script>
-function toggleCollapse(id) {
-    var content = document.getElementById(id);
-    if (content.style.display === "none" || content.style.display === "") {
-        content.style.display = "block";
-    } else {
-        content.style.display = "none";
-    }
-}
+BASE_JS_SOURCE = '''
 function runScript(button) {
     var container = button.parentNode;
     var output = container.querySelector('.script-output');
@@ -1126,9 +1443,44 @@ document.addEventListener('DOMContentLoaded', function() {
         el.style.display = 'none';
     });
 });
-</script>
+document.addEventListener('click', function(e) {
+    var button = e.target.closest('.wiki-button');
+    if (button) {
+        var output = document.createElement('div');
+        output.className = 'button-output';
+        output.innerHTML = button.dataset.touchEvent;
+        button.parentNode.insertBefore(output, button.nextSibling);
+        return;
+    }
+    var collapsibleBtn = e.target.closest('.collapsible-btn');
+    if (collapsibleBtn) {
+        var content = collapsibleBtn.nextElementSibling;
+        content.style.display = (content.style.display === "none" || content.style.display === "") ? "block" : "none";
+    }
+});
 '''
 
+# 公共样式和脚本作为静态文件单独提供，浏览器可以长期缓存
+# URL中带内容哈希作为版本号，内容变化后URL随之变化
+STATIC_ASSETS = {
+    'base.css': (BASE_CSS_SOURCE.encode(), 'text/css'),
+    'base.js': (BASE_JS_SOURCE.encode(), 'application/javascript'),
+}
+
+def static_asset_url(name):
+    return f'/static/{name}?v={hashlib.blake2b(STATIC_ASSETS[name][0], digest_size=6).hexdigest()}'
+
+BASE_CSS = f'<link rel="stylesheet" href="{static_asset_url("base.css")}">'
+BASE_JS = f'<script src="{static_asset_url("base.js")}"></script>'
+
+@app.route('/static/<any("base.css", "base.js"):name>')
+def static_asset(name):
+    body, mimetype = STATIC_ASSETS[name]
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/')
 def root():
     return redirect('/wiki/HomePage')
@@ -1138,114 +1490,54 @@ def root():
 def wiki_home():
     return redirect('/wiki/HomePage')
 
-@app.route('/wiki/<path:page_title>')
-def wiki_page(page_title):
-    # URL解码
-    page_title = urllib.parse.unquote(page_title)
-    
-    settings = get_settings()
-    stats = get_stats()
-    
-    user = None
-    if 'user_id' in session:
-        user = get_user(session.get('username'))
-    
-    page = get_page(page_title)
-    if page:
-        content = page[2]
-    else:
-        content = f"# 页面不存在\n页面 **{page_title}** 尚未创建。\n\n[点击编辑此页面](/wiki/edit/{urllib.parse.quote(page_title)})"
-    
-    html_content = parser.parse_to_html(content, page_title)
-    
-    # 准备URL编码的页面标题
-    encoded_title = urllib.parse.quote(page_title)
-    
-    template = '''
+# 各页面的Jinja模板，启动时注册到DictLoader，首次渲染时编译一次后常驻内存
+# .html 结尾的模板默认开启自动转义，需要原样输出的HTML用Markup传入
+TEMPLATES = {
+    'wiki_page.html': '''
     <!DOCTYPE html>
     <html lang="zh-CN">
     <head>
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>''' + page_title + ''' - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>{{ page_title }} - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="search-box">
                         <input type="text" placeholder="搜索页面..." id="search-input">
                     </div>
                     <div class="user-info">
-    '''
-    
-    if 'user_id' in session:
-        template += '<span>欢迎，' + session.get('username', '') + '</span>'
-    
-    if user and user[4] == 1:
-        template += '<a href="/wiki/settings">设置</a>'
-        template += '<a href="/wiki/templates">模板管理</a>'
-    
-    if 'user_id' in session:
-        template += '<a href="/wiki/logout">退出</a>'
-    else:
-        template += '<a href="/wiki/login" class="login-btn">登录</a>'
-    
-    if settings["allow_registration"] and 'user_id' not in session:
-        template += '<a href="/wiki/register" class="register-btn">注册</a>'
-    
-    template += '''
+                    {% if username is not none %}<span>欢迎，{{ username }}</span>{% endif %}{{ user_links }}
                     </div>
                 </div>
             </header>
             <div class="page-header">
-                <h1 class="page-title">''' + page_title + '''</h1>
+                <h1 class="page-title">{{ page_title }}</h1>
                 <div class="page-actions">
-                    <a href="/wiki/edit/''' + encoded_title + '''" class="action-btn edit-btn">编辑</a>
+                    <a href="/wiki/edit/{{ encoded_title }}" class="action-btn edit-btn">编辑</a>
                     <a href="/wiki/upload" class="action-btn upload-btn">上传文件</a>
-    '''
-    
-    if user and user[4] == 1:
-        template += '<a href="/wiki/protect/' + encoded_title + '" class="action-btn">保护</a>'
-        template += '<a href="/wiki/move/' + encoded_title + '" class="action-btn">移动</a>'
-        template += '<a href="/wiki/delete/' + encoded_title + '" class="action-btn">删除</a>'
-    
-    template += '''
+                    {{ page_actions }}
                 </div>
             </div>
             <div class="wiki-content">
-                ''' + html_content + '''
+                {{ html_content }}
             </div>
             <footer class="wiki-footer">
                 <div class="footer-content">
                     <div class="footer-section">
-                        <h3>''' + settings["wiki_name"] + '''</h3>
-                        <p>''' + settings["site_description"] + '''</p>
+                        <h3>{{ settings.wiki_name }}</h3>
+                        <p>{{ settings.site_description }}</p>
                     </div>
                     <div class="footer-section">
                         <h3>统计信息</h3>
-                        <div class="footer-stats">
-                            <div class="stat-item">
-                                <span class="stat-value">''' + str(stats["pages"]) + '''</span>
-                                <span class="stat-label">页面</span>
-                            </div>
-                            <div class="stat-item">
-                                <span class="stat-value">''' + str(stats["users"]) + '''</span>
-                                <span class="stat-label">用户</span>
-                            </div>
-                            <div class="stat-item">
-                                <span class="stat-value">''' + str(stats["edits"]) + '''</span>
-                                <span class="stat-label">编辑</span>
-                            </div>
-                            <div class="stat-item">
-                                <span class="stat-value">''' + (stats["first_edit"][:10] if stats["first_edit"] else "N/A") + '''</span>
-                                <span class="stat-label">始于</span>
-                            </div>
+                        <div class="footer-stats">{{ stats_footer }}
                         </div>
                     </div>
                 </div>
@@ -1255,70 +1547,22 @@ def wiki_page(page_title):
                 </div>
             </footer>
         </div>
-        ''' + BASE_JS + '''
+        {{ base_js }}
     </body>
     </html>
-    '''
-    
-    return template
-
-@app.route('/wiki/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        
-        user = get_user(username)
-        if user and user[2] == hash_password(password):
-            session['user_id'] = user[0]
-            session['username'] = user[1]
-            session['is_admin'] = user[4]
-            return redirect(request.args.get('next') or '/wiki/HomePage')
-        
-        error = "用户名或密码错误"
-        return render_template_string('''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>登录 - TxPyWiki</title>
-        ''' + BASE_CSS + '''
-        </head>
-        <body>
-            <div class="wiki-container">
-                <div class="form-container">
-                    <h2>登录</h2>
-                    <div class="error-message">''' + error + '''</div>
-                    <form method="post">
-                        <div class="form-group">
-                            <label>用户名:</label>
-                            <input type="text" name="username" required>
-                        </div>
-                        <div class="form-group">
-                            <label>密码:</label>
-                            <input type="password" name="password" required>
-                        </div>
-                        <button type="submit" class="form-btn">登录</button>
-                    </form>
-                    <p style="margin-top: 20px; text-align: center;">
-                        还没有账户？ <a href="/wiki/register">注册</a>
-                    </p>
-                </div>
-            </div>
-        </body>
-        </html>
-        ''')
-    
-    return render_template_string('''
+    ''',
+    'login.html': '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>登录 - TxPyWiki</title>
-    ''' + BASE_CSS + '''
+    {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <div class="form-container">
                 <h2>登录</h2>
+                {% if error %}<div class="error-message">{{ error }}</div>{% endif %}
                 <form method="post">
                     <div class="form-group">
                         <label>用户名:</label>
@@ -1337,79 +1581,19 @@ def login():
         </div>
     </body>
     </html>
-    ''')
-
-@app.route('/wiki/register', methods=['GET', 'POST'])
-def register():
-    settings = get_settings()
-    if not settings["allow_registration"]:
-        return "注册已关闭", 403
-    
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        confirm_password = request.form.get('confirm_password')
-        
-        if password != confirm_password:
-            error = "两次输入的密码不一致"
-        elif len(username) < 3:
-            error = "用户名至少需要3个字符"
-        elif len(password) < 6:
-            error = "密码至少需要6个字符"
-        elif get_user(username):
-            error = "用户名已存在"
-        else:
-            if create_user(username, password):
-                return redirect('/wiki/login')
-            error = "注册失败，请稍后再试"
-        
-        return render_template_string('''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>注册 - TxPyWiki</title>
-        ''' + BASE_CSS + '''
-        </head>
-        <body>
-            <div class="wiki-container">
-                <div class="form-container">
-                    <h2>注册</h2>
-                    <div class="error-message">''' + error + '''</div>
-                    <form method="post">
-                        <div class="form-group">
-                            <label>用户名:</label>
-                            <input type="text" name="username" required>
-                        </div>
-                        <div class="form-group">
-                            <label>密码:</label>
-                            <input type="password" name="password" required>
-                        </div>
-                        <div class="form-group">
-                            <label>确认密码:</label>
-                            <input type="password" name="confirm_password" required>
-                        </div>
-                        <button type="submit" class="form-btn">注册</button>
-                    </form>
-                    <p style="margin-top: 20px; text-align: center;">
-                        已有账户？ <a href="/wiki/login">登录</a>
-                    </p>
-                </div>
-            </div>
-        </body>
-        </html>
-        ''')
-    
-    return render_template_string('''
+    ''',
+    'register.html': '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>注册 - TxPyWiki</title>
-    ''' + BASE_CSS + '''
+    {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <div class="form-container">
                 <h2>注册</h2>
+                {% if error %}<div class="error-message">{{ error }}</div>{% endif %}
                 <form method="post">
                     <div class="form-group">
                         <label>用户名:</label>
@@ -1432,72 +1616,31 @@ def register():
         </div>
     </body>
     </html>
-    ''')
-
-@app.route('/wiki/logout')
-def logout():
-    session.clear()
-    return redirect('/wiki/HomePage')
-
-@app.route('/wiki/edit/<path:page_title>', methods=['GET', 'POST'])
-def wiki_edit(page_title):
-    page_title = urllib.parse.unquote(page_title)
-    
-    settings = get_settings()
-    user = None
-    if 'user_id' in session:
-        user = get_user(session.get('username'))
-    
-    if not can_edit_page(page_title, user):
-        return "您没有编辑此页面的权限", 403
-    
-    page = get_page(page_title)
-    content = page[2] if page else ""
-    
-    if request.method == 'POST':
-        new_content = request.form.get('content')
-        user_id = session.get('user_id') if 'user_id' in session else None
-        
-        if page:
-            update_page(page_title, new_content, user_id)
-        else:
-            create_page(page_title, new_content, user_id)
-        
-        return redirect(f'/wiki/{urllib.parse.quote(page_title)}')
-    
-    encoded_title = urllib.parse.quote(page_title)
-    
-    template = '''
+    ''',
+    'edit.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>编辑 ''' + page_title + ''' - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>编辑 {{ page_title }} - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="user-info">
-    '''
-    
-    if 'user_id' in session:
-        template += '<span>欢迎，' + session.get('username', '') + '</span>'
-    
-    template += '<a href="/wiki/' + encoded_title + '">取消编辑</a>'
-    
-    template += '''
+                    {% if username is not none %}<span>欢迎，{{ username }}</span>{% endif %}<a href="/wiki/{{ encoded_title }}">取消编辑</a>
                     </div>
                 </div>
             </header>
             <div class="editor-container">
-                <h2>编辑: ''' + page_title + '''</h2>
+                <h2>编辑: {{ page_title }}</h2>
                 <form method="post">
-                    <textarea name="content" class="editor-textarea">''' + html.escape(content) + '''</textarea>
+                    <textarea name="content" class="editor-textarea">{{ content }}</textarea>
                     <div class="editor-help">
                         使用TxPyWiki语法编辑。注意：表格中使用\\\\分隔列，普通链接中使用\\分隔。
                     </div>
@@ -1507,65 +1650,24 @@ def wiki_edit(page_title):
         </div>
     </body>
     </html>
-    '''
-    
-    return template
-
-@app.route('/wiki/upload', methods=['GET', 'POST'])
-@login_required
-def upload_file():
-    settings = get_settings()
-    
-    if request.method == 'POST':
-        if 'file' not in request.files:
-            return "没有选择文件", 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return "没有选择文件", 400
-        
-        if file:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(FILES_DIR, filename)
-            
-            file.seek(0, os.SEEK_END)
-            file_size = file.tell()
-            file.seek(0)
-            
-            if file_size > settings["max_file_size"]:
-                return f"文件太大，最大允许 {settings['max_file_size'] // 1024 // 1024}MB", 400
-            
-            file.save(filepath)
-            
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute('''INSERT INTO files (filename, original_name, filepath, size, uploaded_by) 
-                         VALUES (?, ?, ?, ?, ?)''',
-                      (filename, file.filename, filepath, file_size, session['user_id']))
-            conn.commit()
-            conn.close()
-            
-            return redirect(f'/wiki/{session.get("username", "")}')
-    
-    max_size_mb = settings["max_file_size"] // 1024 // 1024
-    
-    return '''
+    ''',
+    'upload.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>上传文件 - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>上传文件 - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="user-info">
-                        <span>欢迎，''' + session.get('username', '') + '''</span>
+                        <span>欢迎，{{ username }}</span>
                         <a href="/wiki/HomePage">返回首页</a>
                     </div>
                 </div>
@@ -1574,7 +1676,7 @@ def upload_file():
                 <h2>上传文件</h2>
                 <form method="post" enctype="multipart/form-data">
                     <div class="form-group">
-                        <label>选择文件 (最大 ''' + str(max_size_mb) + '''MB):</label>
+                        <label>选择文件 (最大 {{ max_size_mb }}MB):</label>
                         <input type="file" name="file" required>
                     </div>
                     <button type="submit" class="form-btn">上传</button>
@@ -1586,241 +1688,146 @@ def upload_file():
         </div>
     </body>
     </html>
-    '''
-
-@app.route('/wiki/files/<filename>')
-def serve_file(filename):
-    filepath = os.path.join(FILES_DIR, filename)
-    if os.path.exists(filepath):
-        return app.send_static_file(filepath)
-    return "文件不存在", 404
-
-@app.route('/wiki/settings', methods=['GET', 'POST'])
-@admin_required
-def wiki_settings():
-    settings = get_settings()
-    
-    if request.method == 'POST':
-        new_settings = {}
-        for key in DEFAULT_SETTINGS.keys():
-            if key in request.form:
-                value = request.form.get(key)
-                if key in ['max_file_size', 'max_files_per_user', 'max_total_files', 'max_total_size']:
-                    new_settings[key] = int(value)
-                elif key in ['allow_anonymous_edit', 'allow_registration']:
-                    new_settings[key] = value.lower() in ['true', 'yes', '1', 'on']
-                else:
-                    new_settings[key] = value
-        
-        save_settings(new_settings)
-        settings = get_settings()
-    
-    allow_anonymous_selected = 'selected' if settings["allow_anonymous_edit"] else ''
-    allow_registration_selected = 'selected' if settings["allow_registration"] else ''
-    
-    everyone_selected = 'selected' if settings["default_protection"] == 'everyone' else ''
-    loggedin_selected = 'selected' if settings["default_protection"] == 'loggedin' else ''
-    admin_selected = 'selected' if settings["default_protection"] == 'admin' else ''
-    
-    template = '''
+    ''',
+    'settings.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>设置 - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>设置 - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="user-info">
-                        <span>管理员: ''' + session.get('username', '') + '''</span>
+                        <span>管理员: {{ username }}</span>
                         <a href="/wiki/HomePage">返回首页</a>
                     </div>
                 </div>
             </header>
             <div class="editor-container">
                 <h2>Wiki设置</h2>
-                <form method="post">
-                    <div class="form-group">
-                        <label>Wiki名称:</label>
-                        <input type="text" name="wiki_name" value="''' + settings["wiki_name"] + '''">
-                    </div>
-                    <div class="form-group">
-                        <label>Wiki图标URL:</label>
-                        <input type="text" name="wiki_icon" value="''' + settings["wiki_icon"] + '''">
-                    </div>
-                    <div class="form-group">
-                        <label>站点描述:</label>
-                        <input type="text" name="site_description" value="''' + settings["site_description"] + '''">
-                    </div>
-                    <div class="form-group">
-                        <label>最大文件大小 (字节):</label>
-                        <input type="number" name="max_file_size" value="''' + str(settings["max_file_size"]) + '''">
-                    </div>
-                    <div class="form-group">
-                        <label>每个用户最大文件数:</label>
-                        <input type="number" name="max_files_per_user" value="''' + str(settings["max_files_per_user"]) + '''">
-                    </div>
-                    <div class="form-group">
-                        <label>允许匿名编辑:</label>
-                        <select name="allow_anonymous_edit">
-                            <option value="true" ''' + allow_anonymous_selected + '''>是</option>
-                            <option value="false" ''' + ('' if settings["allow_anonymous_edit"] else 'selected') + '''>否</option>
-                        </select>
-                    </div>
-                    <div class="form-group">
-                        <label>允许注册:</label>
-                        <select name="allow_registration">
-                            <option value="true" ''' + allow_registration_selected + '''>是</option>
-                            <option value="false" ''' + ('' if settings["allow_registration"] else 'selected') + '''>否</option>
-                        </select>
-                    </div>
-                    <div class="form-group">
-                        <label>默认保护级别:</label>
-                        <select name="default_protection">
-                            <option value="everyone" ''' + everyone_selected + '''>所有人都可编辑</option>
-                            <option value="loggedin" ''' + loggedin_selected + '''>仅登录可编辑</option>
-                            <option value="admin" ''' + admin_selected + '''>仅管理员可编辑</option>
-                        </select>
-                    </div>
-                    <button type="submit" class="form-btn">保存设置</button>
-                </form>
+                {{ settings_form }}
             </div>
         </div>
     </body>
     </html>
-    '''
-    
-    return template
-
-@app.route('/wiki/protect/<path:page_title>', methods=['GET', 'POST'])
-@admin_required
-def wiki_protect(page_title):
-    page_title = urllib.parse.unquote(page_title)
-    
-    if request.method == 'POST':
-        level = request.form.get('level')
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("UPDATE pages SET protection_level = ? WHERE title = ?", (level, page_title))
-        conn.commit()
-        conn.close()
-        return redirect(f'/wiki/{urllib.parse.quote(page_title)}')
-    
-    page = get_page(page_title)
-    current_level = page[3] if page else 'everyone'
-    
-    encoded_title = urllib.parse.quote(page_title)
-    
-    everyone_selected = 'selected' if current_level == 'everyone' else ''
-    loggedin_selected = 'selected' if current_level == 'loggedin' else ''
-    admin_selected = 'selected' if current_level == 'admin' else ''
-    
-    return '''
+    ''',
+    'settings_form.html': '''
+    <form method="post">
+        <div class="form-group">
+            <label>Wiki名称:</label>
+            <input type="text" name="wiki_name" value="{{ settings.wiki_name }}">
+        </div>
+        <div class="form-group">
+            <label>Wiki图标URL:</label>
+            <input type="text" name="wiki_icon" value="{{ settings.wiki_icon }}">
+        </div>
+        <div class="form-group">
+            <label>站点描述:</label>
+            <input type="text" name="site_description" value="{{ settings.site_description }}">
+        </div>
+        <div class="form-group">
+            <label>最大文件大小 (字节):</label>
+            <input type="number" name="max_file_size" value="{{ settings.max_file_size }}">
+        </div>
+        <div class="form-group">
+            <label>每个用户最大文件数:</label>
+            <input type="number" name="max_files_per_user" value="{{ settings.max_files_per_user }}">
+        </div>
+        <div class="form-group">
+            <label>允许匿名编辑:</label>
+            <select name="allow_anonymous_edit">
+                <option value="true" {{ 'selected' if settings.allow_anonymous_edit }}>是</option>
+                <option value="false" {{ '' if settings.allow_anonymous_edit else 'selected' }}>否</option>
+            </select>
+        </div>
+        <div class="form-group">
+            <label>允许注册:</label>
+            <select name="allow_registration">
+                <option value="true" {{ 'selected' if settings.allow_registration }}>是</option>
+                <option value="false" {{ '' if settings.allow_registration else 'selected' }}>否</option>
+            </select>
+        </div>
+        <div class="form-group">
+            <label>默认保护级别:</label>
+            <select name="default_protection">
+                <option value="everyone" {{ 'selected' if settings.default_protection == 'everyone' }}>所有人都可编辑</option>
+                <option value="loggedin" {{ 'selected' if settings.default_protection == 'loggedin' }}>仅登录可编辑</option>
+                <option value="admin" {{ 'selected' if settings.default_protection == 'admin' }}>仅管理员可编辑</option>
+            </select>
+        </div>
+        <button type="submit" class="form-btn">保存设置</button>
+    </form>
+    ''',
+    'protect.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>保护 ''' + page_title + '''</title>
-        ''' + BASE_CSS + '''
+        <title>保护 {{ page_title }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <div class="form-container">
-                <h2>保护页面: ''' + page_title + '''</h2>
+                <h2>保护页面: {{ page_title }}</h2>
                 <form method="post">
                     <div class="form-group">
                         <label>保护级别:</label>
                         <select name="level">
-                            <option value="everyone" ''' + everyone_selected + '''>所有人都可编辑</option>
-                            <option value="loggedin" ''' + loggedin_selected + '''>仅登录用户可编辑</option>
-                            <option value="admin" ''' + admin_selected + '''>仅管理员可编辑</option>
+                            <option value="everyone" {{ 'selected' if current_level == 'everyone' }}>所有人都可编辑</option>
+                            <option value="loggedin" {{ 'selected' if current_level == 'loggedin' }}>仅登录用户可编辑</option>
+                            <option value="admin" {{ 'selected' if current_level == 'admin' }}>仅管理员可编辑</option>
                         </select>
                     </div>
                     <button type="submit" class="form-btn">保存</button>
-                    <a href="/wiki/''' + encoded_title + '''" class="action-btn" style="margin-left: 10px;">取消</a>
+                    <a href="/wiki/{{ encoded_title }}" class="action-btn" style="margin-left: 10px;">取消</a>
                 </form>
             </div>
         </div>
     </body>
     </html>
-    '''
-
-@app.route('/wiki/move/<path:page_title>', methods=['GET', 'POST'])
-@admin_required
-def wiki_move(page_title):
-    page_title = urllib.parse.unquote(page_title)
-    
-    if request.method == 'POST':
-        new_title = request.form.get('new_title')
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("UPDATE pages SET title = ? WHERE title = ?", (new_title, page_title))
-        conn.commit()
-        conn.close()
-        return redirect(f'/wiki/{urllib.parse.quote(new_title)}')
-    
-    encoded_title = urllib.parse.quote(page_title)
-    
-    return '''
+    ''',
+    'move.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>移动 ''' + page_title + '''</title>
-        ''' + BASE_CSS + '''
+        <title>移动 {{ page_title }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <div class="form-container">
-                <h2>移动页面: ''' + page_title + '''</h2>
+                <h2>移动页面: {{ page_title }}</h2>
                 <form method="post">
                     <div class="form-group">
                         <label>新页面标题:</label>
-                        <input type="text" name="new_title" value="''' + page_title + '''" required>
+                        <input type="text" name="new_title" value="{{ page_title }}" required>
                     </div>
                     <button type="submit" class="form-btn">移动</button>
-                    <a href="/wiki/''' + encoded_title + '''" class="action-btn" style="margin-left: 10px;">取消</a>
+                    <a href="/wiki/{{ encoded_title }}" class="action-btn" style="margin-left: 10px;">取消</a>
                 </form>
             </div>
         </div>
     </body>
     </html>
-    '''
-
-@app.route('/wiki/delete/<path:page_title>', methods=['GET', 'POST'])
-@admin_required
-def wiki_delete(page_title):
-    page_title = urllib.parse.unquote(page_title)
-    
-    if request.method == 'POST':
-        confirm = request.form.get('confirm')
-        if confirm == 'yes':
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("DELETE FROM pages WHERE title = ?", (page_title,))
-            conn.commit()
-            conn.close()
-            return redirect('/wiki/HomePage')
-        else:
-            return redirect(f'/wiki/{urllib.parse.quote(page_title)}')
-    
-    encoded_title = urllib.parse.quote(page_title)
-    
-    return '''
+    ''',
+    'delete.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>删除 ''' + page_title + '''</title>
-        ''' + BASE_CSS + '''
+        <title>删除 {{ page_title }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <div class="form-container">
-                <h2>删除页面: ''' + page_title + '''</h2>
+                <h2>删除页面: {{ page_title }}</h2>
                 <p style="color: #d73a49; margin-bottom: 20px;">
                     警告：此操作不可撤销！页面将被永久删除。
                 </p>
@@ -1830,96 +1837,30 @@ def wiki_delete(page_title):
                         <input type="text" name="confirm" required>
                     </div>
                     <button type="submit" class="form-btn" style="background: #d73a49;">删除</button>
-                    <a href="/wiki/''' + encoded_title + '''" class="action-btn" style="margin-left: 10px;">取消</a>
+                    <a href="/wiki/{{ encoded_title }}" class="action-btn" style="margin-left: 10px;">取消</a>
                 </form>
             </div>
         </div>
     </body>
     </html>
-    '''
-
-@app.route('/wiki/templates', methods=['GET', 'POST'])
-@admin_required
-def wiki_templates():
-    settings = get_settings()
-    
-    templates = []
-    if os.path.exists(PAGES_DIR):
-        for filename in os.listdir(PAGES_DIR):
-            if filename.startswith("TEMPLATE."):
-                template_name = filename[9:]
-                if '.' in template_name:
-                    template_name = template_name.split('.')[0]
-                try:
-                    with open(os.path.join(PAGES_DIR, filename), 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        templates.append({
-                            'name': template_name,
-                            'filename': filename,
-                            'content': content[:200] + '...' if len(content) > 200 else content
-                        })
-                except:
-                    pass
-    
-    if request.method == 'POST':
-        action = request.form.get('action')
-        template_name = request.form.get('template_name')
-        
-        if action == 'create':
-            content = request.form.get('content')
-            filename = f"TEMPLATE.{template_name}.3p"
-            with open(os.path.join(PAGES_DIR, filename), 'w', encoding='utf-8') as f:
-                f.write(content)
-            return redirect('/wiki/templates')
-        
-        elif action == 'edit':
-            content = request.form.get('content')
-            filename = f"TEMPLATE.{template_name}.3p"
-            with open(os.path.join(PAGES_DIR, filename), 'w', encoding='utf-8') as f:
-                f.write(content)
-            return redirect('/wiki/templates')
-        
-        elif action == 'delete':
-            filename = f"TEMPLATE.{template_name}.3p"
-            filepath = os.path.join(PAGES_DIR, filename)
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            return redirect('/wiki/templates')
-    
-    template_items = ''
-    for t in templates:
-        template_items += '''
-        <div class="template-item">
-            <h4>''' + t['name'] + '''</h4>
-            <div class="template-preview">''' + html.escape(t['content']) + '''</div>
-            <div style="margin-top: 10px;">
-                <a href="/wiki/edit_template/''' + t['name'] + '''" class="action-btn" style="margin-right: 10px;">编辑</a>
-                <form method="post" style="display:inline;">
-                    <input type="hidden" name="action" value="delete">
-                    <input type="hidden" name="template_name" value="''' + t['name'] + '''">
-                    <button type="submit" class="action-btn" style="background: #d73a49; color: white; border: none;">删除</button>
-                </form>
-            </div>
-        </div>
-        '''
-    
-    return '''
+    ''',
+    'templates.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>模板管理 - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>模板管理 - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="user-info">
-                        <span>管理员: ''' + session.get('username', '') + '''</span>
+                        <span>管理员: {{ username }}</span>
                         <a href="/wiki/HomePage">返回首页</a>
                     </div>
                 </div>
@@ -1944,59 +1885,52 @@ def wiki_templates():
                 <div>
                     <h3>现有模板</h3>
                     <div class="template-list">
-                        ''' + template_items + '''
+                    {% for t in templates %}
+                        <div class="template-item">
+                            <h4>{{ t.name }}</h4>
+                            <div class="template-preview">{{ t.content }}</div>
+                            <div style="margin-top: 10px;">
+                                <a href="/wiki/edit_template/{{ t.name }}" class="action-btn" style="margin-right: 10px;">编辑</a>
+                                <form method="post" style="display:inline;">
+                                    <input type="hidden" name="action" value="delete">
+                                    <input type="hidden" name="template_name" value="{{ t.name }}">
+                                    <button type="submit" class="action-btn" style="background: #d73a49; color: white; border: none;">删除</button>
+                                </form>
+                            </div>
+                        </div>
+                    {% endfor %}
                     </div>
                 </div>
             </div>
         </div>
     </body>
     </html>
-    '''
-
-@app.route('/wiki/edit_template/<template_name>', methods=['GET', 'POST'])
-@admin_required
-def wiki_edit_template(template_name):
-    settings = get_settings()
-    filename = f"TEMPLATE.{template_name}.3p"
-    filepath = os.path.join(PAGES_DIR, filename)
-    
-    if not os.path.exists(filepath):
-        return "模板不存在", 404
-    
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    if request.method == 'POST':
-        new_content = request.form.get('content')
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(new_content)
-        return redirect('/wiki/templates')
-    
-    return '''
+    ''',
+    'edit_template.html': '''
     <!DOCTYPE html>
     <html>
     <head>
-        <title>编辑模板 ''' + template_name + ''' - ''' + settings["wiki_name"] + '''</title>
-        ''' + BASE_CSS + '''
+        <title>编辑模板 {{ template_name }} - {{ settings.wiki_name }}</title>
+        {{ base_css }}
     </head>
     <body>
         <div class="wiki-container">
             <header class="wiki-header">
                 <div class="header-content">
                     <div class="wiki-brand">
-                        <img src="''' + settings["wiki_icon"] + '''" alt="图标" class="wiki-icon">
-                        <a href="/wiki/HomePage" class="wiki-title">''' + settings["wiki_name"] + '''</a>
+                        <img src="{{ settings.wiki_icon }}" alt="图标" class="wiki-icon">
+                        <a href="/wiki/HomePage" class="wiki-title">{{ settings.wiki_name }}</a>
                     </div>
                     <div class="user-info">
-                        <span>管理员: ''' + session.get('username', '') + '''</span>
+                        <span>管理员: {{ username }}</span>
                         <a href="/wiki/templates">返回模板管理</a>
                     </div>
                 </div>
             </header>
             <div class="editor-container">
-                <h2>编辑模板: ''' + template_name + '''</h2>
+                <h2>编辑模板: {{ template_name }}</h2>
                 <form method="post">
-                    <textarea name="content" class="editor-textarea">''' + html.escape(content) + '''</textarea>
+                    <textarea name="content" class="editor-textarea">{{ content }}</textarea>
                     <div class="editor-help">
                         使用<plantext>标签包裹示例代码，如: &lt;plantext&gt;示例代码&lt;/plantext&gt;
                     </div>
@@ -2007,7 +1941,476 @@ def wiki_edit_template(template_name):
         </div>
     </body>
     </html>
-    '''
+    ''',
+    'setup_admin.html': '''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>TxPyWiki 初始化</title>
+    {{ base_css }}
+    </head>
+    <body>
+        <div class="wiki-container">
+            <div class="form-container">
+                <h2>TxPyWiki 初始化设置</h2>
+                <p style="margin-bottom: 20px;">
+                    欢迎使用TxPyWiki！首先需要创建一个管理员账户。
+                </p>
+                <form method="post">
+                    <div class="form-group">
+                        <label>管理员用户名:</label>
+                        <input type="text" name="username" required>
+                    </div>
+                    <div class="form-group">
+                        <label>密码:</label>
+                        <input type="password" name="password" required>
+                    </div>
+                    <div class="form-group">
+                        <label>确认密码:</label>
+                        <input type="password" name="confirm_password" required>
+                    </div>
+                    <button type="submit" class="form-btn">创建管理员账户</button>
+                </form>
+            </div>
+        </div>
+    </body>
+    </html>
+    ''',
+}
+
+app.jinja_loader = DictLoader(TEMPLATES)
+app.jinja_env.globals.update(base_css=Markup(BASE_CSS), base_js=Markup(BASE_JS))
+
+# 右上角用户链接只有四种组合：游客、游客(开放注册)、登录用户、管理员
+_USER_LINKS = (
+    Markup('<a href="/wiki/login" class="login-btn">登录</a>'),
+    Markup('<a href="/wiki/login" class="login-btn">登录</a><a href="/wiki/register" class="register-btn">注册</a>'),
+    Markup('<a href="/wiki/logout">退出</a>'),
+    Markup('<a href="/wiki/settings">设置</a><a href="/wiki/templates">模板管理</a><a href="/wiki/logout">退出</a>'),
+)
+
+# 管理员才有的页面操作按钮，只需填入页面标题
+_PAGE_ACTIONS_ADMIN = Markup(
+    '<a href="/wiki/protect/{title}" class="action-btn">保护</a>'
+    '<a href="/wiki/move/{title}" class="action-btn">移动</a>'
+    '<a href="/wiki/delete/{title}" class="action-btn">删除</a>'
+)
+_PAGE_ACTIONS_USER = Markup('')
+
+@app.route('/wiki/<path:page_title>')
+def wiki_page(page_title):
+    # URL解码
+    page_title = urllib.parse.unquote(page_title)
+    
+    settings = get_settings()
+    
+    is_admin = 'user_id' in session and session.get('is_admin') == 1
+    
+    encoded_title = fast_quote(page_title)
+    
+    page = get_page(page_title)
+    if page:
+        content = page['content']
+    else:
+        content = f"# 页面不存在\n页面 **{page_title}** 尚未创建。\n\n[点击编辑此页面](/wiki/edit/{encoded_title})"
+    
+    html_content, cacheable = render_page(content, page_title)
+    username = session.get('username', '') if 'user_id' in session else None
+    stats_footer = get_stats_footer()
+    
+    # ETag覆盖页面上所有会变化的部分，浏览器带着相同的ETag再次请求时直接返回304
+    etag = None
+    if cacheable:
+        etag = hashlib.blake2b('\0'.join((
+            html_content, repr(settings), username or '', str(is_admin), stats_footer, BASE_CSS, BASE_JS,
+        )).encode(), digest_size=16).hexdigest()
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+    
+    if 'user_id' in session:
+        user_links = _USER_LINKS[3 if is_admin else 2]
+    else:
+        user_links = _USER_LINKS[1 if settings["allow_registration"] else 0]
+    
+    # 页面可能很长，边渲染边发送，不在内存中拼出完整的HTML
+    response = app.response_class(stream_template('wiki_page.html',
+        page_title=page_title,
+        encoded_title=encoded_title,
+        settings=settings,
+        stats_footer=stats_footer,
+        username=username,
+        user_links=user_links,
+        page_actions=_PAGE_ACTIONS_ADMIN.format(title=encoded_title) if is_admin else _PAGE_ACTIONS_USER,
+        html_content=Markup(html_content),
+    ), mimetype='text/html')
+    if etag:
+        response.set_etag(etag)
+        # 页面内容与登录状态有关，只允许浏览器私有缓存，每次使用前重新验证
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/wiki/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        
+        user = get_user(username)
+        if user and check_password(user['password_hash'], password):
+            session['user_id'] = user['id']
+            session['username'] = user['username']
+            session['is_admin'] = user['is_admin']
+            return redirect(request.args.get('next') or '/wiki/HomePage')
+        
+        return render_template('login.html', error="用户名或密码错误")
+    
+    return render_template('login.html')
+
+@app.route('/wiki/register', methods=['GET', 'POST'])
+def register():
+    settings = get_settings()
+    if not settings["allow_registration"]:
+        return "注册已关闭", 403
+    
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        confirm_password = request.form.get('confirm_password')
+        
+        if password != confirm_password:
+            error = "两次输入的密码不一致"
+        elif len(username) < 3:
+            error = "用户名至少需要3个字符"
+        elif len(password) < 6:
+            error = "密码至少需要6个字符"
+        elif get_user(username):
+            error = "用户名已存在"
+        else:
+            if create_user(username, password):
+                return redirect('/wiki/login')
+            error = "注册失败，请稍后再试"
+    
+        return render_template('register.html', error=error)
+    
+    return render_template('register.html')
+
+@app.route('/wiki/logout')
+def logout():
+    session.clear()
+    return redirect('/wiki/HomePage')
+
+@app.route('/wiki/edit/<path:page_title>', methods=['GET', 'POST'])
+def wiki_edit(page_title):
+    page_title = urllib.parse.unquote(page_title)
+    
+    settings = get_settings()
+    logged_in = 'user_id' in session
+    
+    if not can_edit_page(page_title, logged_in, logged_in and session.get('is_admin') == 1):
+        return "您没有编辑此页面的权限", 403
+    
+    if request.method == 'POST':
+        content = request.form.get('content')
+        if content is None:
+            return "缺少页面内容", 400
+        save_page(page_title, content, session.get('user_id'))
+        return redirect(f'/wiki/{fast_quote(page_title)}')
+    
+    return render_template('edit.html',
+        page_title=page_title,
+        encoded_title=fast_quote(page_title),
+        settings=settings,
+        username=session.get('username', '') if 'user_id' in session else None,
+        content=get_edit_content(page_title),
+    )
+
+@app.route('/wiki/upload', methods=['GET', 'POST'])
+@login_required
+def upload_file():
+    settings = get_settings()
+    
+    if request.method == 'POST':
+        too_large = f"文件太大，最大允许 {settings['max_file_size'] // 1024 // 1024}MB"
+        # 在解析请求体之前按Content-Length拒绝，超大的上传不会被缓冲到内存或临时文件
+        # multipart的边界和头部会占用一些字节，这里留出余量，保存后再按实际大小精确检查
+        limit = settings["max_file_size"] + UPLOAD_OVERHEAD
+        if request.content_length is not None and request.content_length > limit:
+            return too_large, 413
+        request.max_content_length = limit
+        
+        with read_pool.cursor() as c:
+            c.execute("SELECT COUNT(*) FROM files WHERE uploaded_by = ?", (session['user_id'],))
+            if c.fetchone()[0] >= settings["max_files_per_user"]:
+                return f"每个用户最多上传 {settings['max_files_per_user']} 个文件", 400
+        
+        if 'file' not in request.files:
+            return "没有选择文件", 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return "没有选择文件", 400
+        
+        if file:
+            filename = secure_filename(file.filename)
+            filepath = os.path.join(FILES_DIR, filename)
+            
+            # 请求体解析后文件已经在内存或临时文件中，保存前先检查大小，不会覆盖已有的同名文件
+            file.stream.seek(0, os.SEEK_END)
+            file_size = file.stream.tell()
+            file.stream.seek(0)
+            if file_size > settings["max_file_size"]:
+                return too_large, 413
+            
+            file.save(filepath)
+            
+            add_file(filename, file.filename, filepath, file_size, session['user_id'])
+            
+            return redirect(f'/wiki/{session.get("username", "")}')
+    
+    return render_template('upload.html',
+        settings=settings,
+        username=session.get('username', ''),
+        max_size_mb=settings["max_file_size"] // 1024 // 1024,
+    )
+
+# 文件名 -> 绝对路径，同一文件被多个页面反复引用时不必每次都检查磁盘
+# 只缓存存在的文件，刚上传的文件不会被之前的查询结果挡住；文件在外部被删除时由 serve_file 发现并移除
+_RESOLVED_FILES = {}
+_RESOLVED_FILES_SIZE = 4096
+
+def _resolve_file(filename):
+    path = _RESOLVED_FILES.get(filename)
+    if path is not None:
+        return path
+    # safe_join 保证路径不越出 FILES_DIR
+    path = safe_join(os.path.abspath(FILES_DIR), filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    if len(_RESOLVED_FILES) >= _RESOLVED_FILES_SIZE:
+        _RESOLVED_FILES.clear()
+    _RESOLVED_FILES[filename] = path
+    return path
+
+@app.route('/wiki/files/<filename>')
+def serve_file(filename):
+    path = _resolve_file(filename)
+    if path is None:
+        return "文件不存在", 404
+    try:
+        # conditional=True 支持条件请求和Range
+        return send_file(path, conditional=True)
+    except FileNotFoundError:
+        _RESOLVED_FILES.pop(filename, None)
+        return "文件不存在", 404
+
+# 设置表单只取决于当前设置，按设置快照缓存渲染结果，设置重新加载后才重新渲染
+# (设置快照, html) 整体替换，并发渲染时不会出现快照与HTML不对应
+_settings_form_cache = {'entry': (None, None)}
+
+def get_settings_form(settings):
+    cached_settings, form_html = _settings_form_cache['entry']
+    if cached_settings is not settings:
+        form_html = Markup(render_template('settings_form.html', settings=settings))
+        _settings_form_cache['entry'] = (settings, form_html)
+    return form_html
+
+@app.route('/wiki/settings', methods=['GET', 'POST'])
+@admin_required
+def wiki_settings():
+    settings = get_settings()
+    
+    if request.method == 'POST':
+        new_settings = {}
+        for key in DEFAULT_SETTINGS.keys():
+            if key in request.form:
+                value = request.form.get(key)
+                if key in ['max_file_size', 'max_files_per_user', 'max_total_files', 'max_total_size']:
+                    new_settings[key] = int(value)
+                elif key in ['allow_anonymous_edit', 'allow_registration']:
+                    new_settings[key] = value.lower() in ['true', 'yes', '1', 'on']
+                else:
+                    new_settings[key] = value
+        
+        save_settings(new_settings)
+        settings = get_settings()
+    
+    return render_template('settings.html',
+        settings=settings,
+        username=session.get('username', ''),
+        settings_form=get_settings_form(settings),
+    )
+
+@app.route('/wiki/protect/<path:page_title>', methods=['GET', 'POST'])
+@admin_required
+def wiki_protect(page_title):
+    page_title = urllib.parse.unquote(page_title)
+    
+    if request.method == 'POST':
+        level = request.form.get('level')
+        set_page_protection(page_title, level)
+        return redirect(f'/wiki/{fast_quote(page_title)}')
+    
+    page = get_page(page_title)
+    current_level = page['protection_level'] if page else 'everyone'
+    
+    return render_template('protect.html',
+        page_title=page_title,
+        encoded_title=fast_quote(page_title),
+        current_level=current_level,
+    )
+
+@app.route('/wiki/move/<path:page_title>', methods=['GET', 'POST'])
+@admin_required
+def wiki_move(page_title):
+    page_title = urllib.parse.unquote(page_title)
+    
+    if request.method == 'POST':
+        new_title = request.form.get('new_title')
+        move_page(page_title, new_title)
+        return redirect(f'/wiki/{fast_quote(new_title)}')
+    
+    return render_template('move.html', page_title=page_title, encoded_title=fast_quote(page_title))
+
+@app.route('/wiki/delete/<path:page_title>', methods=['GET', 'POST'])
+@admin_required
+def wiki_delete(page_title):
+    page_title = urllib.parse.unquote(page_title)
+    
+    if request.method == 'POST':
+        confirm = request.form.get('confirm')
+        if confirm == 'yes':
+            delete_page(page_title)
+            return redirect('/wiki/HomePage')
+        else:
+            return redirect(f'/wiki/{fast_quote(page_title)}')
+    
+    return render_template('delete.html', page_title=page_title, encoded_title=fast_quote(page_title))
+
+# 模板名只允许文字、数字、下划线和连字符，不能带路径分隔符或点
+_RE_TEMPLATE_NAME = re.compile(r'[\w\-]+')
+_TEMPLATE_PREFIX = os.path.join(PAGES_DIR, "TEMPLATE.")
+
+def _template_path(name):
+    """返回模板文件路径，名称不合法时返回None"""
+    if not name or not _RE_TEMPLATE_NAME.fullmatch(name):
+        return None
+    return _TEMPLATE_PREFIX + name + ".3p"
+
+def write_template(filepath, content):
+    # 编码后一次写入临时文件再原子替换，读者不会看到写了一半的模板
+    # 临时文件以点开头，不会被当成模板扫描到
+    data = memoryview(content.encode('utf-8'))
+    tmp_path = os.path.join(os.path.dirname(filepath), '.' + os.path.basename(filepath) + '.tmp')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, filepath)
+
+# 模板管理页的列表缓存，目录修改时间不变时直接复用，不再逐个打开模板文件
+# 原地修改已有模板不会改变目录的修改时间，所以写操作后要主动清零 mtime
+_TEMPLATE_LIST_CACHE = {'mtime': 0, 'items': []}
+
+def get_template_list():
+    if not os.path.exists(PAGES_DIR):
+        return []
+    mtime = os.stat(PAGES_DIR).st_mtime_ns
+    if mtime == _TEMPLATE_LIST_CACHE['mtime']:
+        return _TEMPLATE_LIST_CACHE['items']
+    
+    templates = []
+    # scandir 自带文件类型信息，先按文件名过滤，非模板文件不产生额外的系统调用
+    with os.scandir(PAGES_DIR) as it:
+        for entry in it:
+            m = _RE_TEMPLATE_FILE.match(entry.name)
+            if not m or not entry.is_file(follow_symlinks=False):
+                continue
+            template_name = m.group(1)
+            # 只列出能通过名称编辑和删除的模板：名称合法且文件名正是 TEMPLATE.<名称>.3p
+            filepath = _template_path(template_name)
+            if filepath is None or os.path.basename(filepath) != entry.name:
+                continue
+            try:
+                # 预览只显示前200个字符，多读一个字符用来判断是否被截断
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    head = f.read(201)
+                    templates.append({
+                        'name': template_name,
+                        'filename': entry.name,
+                        'content': head[:200] + '...' if len(head) > 200 else head
+                    })
+            except:
+                pass
+    _TEMPLATE_LIST_CACHE['mtime'], _TEMPLATE_LIST_CACHE['items'] = mtime, templates
+    return templates
+
+@app.route('/wiki/templates', methods=['GET', 'POST'])
+@admin_required
+def wiki_templates():
+    settings = get_settings()
+    
+    if request.method == 'POST':
+        action = request.form.get('action')
+        template_name = request.form.get('template_name')
+        
+        filepath = _template_path(template_name)
+        if filepath is None:
+            return "模板名称无效", 400
+        
+        if action == 'create':
+            content = request.form.get('content')
+            write_template(filepath, content)
+            # 写入完成后再让列表缓存失效，避免并发的请求在写入前重新扫描并缓存旧内容
+            _TEMPLATE_LIST_CACHE['mtime'] = 0
+            return redirect('/wiki/templates')
+        
+        elif action == 'edit':
+            content = request.form.get('content')
+            write_template(filepath, content)
+            _TEMPLATE_LIST_CACHE['mtime'] = 0
+            return redirect('/wiki/templates')
+        
+        elif action == 'delete':
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            _TEMPLATE_LIST_CACHE['mtime'] = 0
+            return redirect('/wiki/templates')
+    
+    # 模板较多时列表很长，逐块渲染发送
+    return app.response_class(stream_template('templates.html',
+        settings=settings,
+        username=session.get('username', ''),
+        templates=get_template_list(),
+    ), mimetype='text/html')
+
+@app.route('/wiki/edit_template/<template_name>', methods=['GET', 'POST'])
+@admin_required
+def wiki_edit_template(template_name):
+    settings = get_settings()
+    filepath = _template_path(template_name)
+    
+    if filepath is None or not os.path.exists(filepath):
+        return "模板不存在", 404
+    
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    if request.method == 'POST':
+        new_content = request.form.get('content')
+        write_template(filepath, new_content)
+        _TEMPLATE_LIST_CACHE['mtime'] = 0
+        return redirect('/wiki/templates')
+    
+    return app.response_class(stream_template('edit_template.html',
+        template_name=template_name,
+        settings=settings,
+        username=session.get('username', ''),
+        content=content,
+    ), mimetype='text/html')
 
 @app.route('/wiki/api/<action>', methods=['GET', 'POST'])
 def wiki_api(action):
@@ -2016,11 +2419,11 @@ def wiki_api(action):
         page = get_page(page_title)
         if page:
             return jsonify({
-                'title': page[1],
-                'content': page[2],
-                'protection': page[3],
-                'created': page[4],
-                'updated': page[5]
+                'title': page['title'],
+                'content': page['content'],
+                'protection': page['protection_level'],
+                'created': page['created_at'],
+                'updated': page['updated_at']
             })
         return jsonify({'error': '页面不存在'}), 404
     
@@ -2030,17 +2433,17 @@ def wiki_api(action):
         username = request.args.get('username')
         password = request.args.get('password')
         
+        if content is None:
+            return jsonify({'error': '缺少页面内容'}), 400
+        
         user = get_user(username)
-        if not user or user[2] != hash_password(password):
+        if not user or not check_password(user['password_hash'], password):
             return jsonify({'error': '认证失败'}), 401
         
-        if not can_edit_page(page_title, user):
+        if not can_edit_page(page_title, True, user['is_admin'] == 1):
             return jsonify({'error': '没有编辑权限'}), 403
         
-        if get_page(page_title):
-            update_page(page_title, content, user[0])
-        else:
-            create_page(page_title, content, user[0])
+        save_page(page_title, content, user['id'])
         
         return jsonify({'success': True})
     
@@ -2062,11 +2465,13 @@ def wiki_api(action):
     
     elif action == 'search':
         query = request.args.get('q', '')
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT title FROM pages WHERE title LIKE ?", (f'%{query}%',))
-        results = [row[0] for row in c.fetchall()]
-        conn.close()
+        with read_pool.cursor() as c:
+            # trigram 索引至少需要3个字符，更短的查询仍走 LIKE
+            if _HAS_FTS and len(query) >= 3:
+                c.execute(_SQL_SEARCH_FTS, ('"' + query.replace('"', '""') + '"',))
+            else:
+                c.execute(_SQL_SEARCH_LIKE, (f'%{query}%',))
+            results = [row[0] for row in c.fetchall()]
         return jsonify({'results': results})
     
     elif action == '' or action == 'help':
@@ -2083,18 +2488,9 @@ def wiki_api(action):
     
     return jsonify({'error': '无效的API操作'}), 400
 
-def check_initial_setup():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users WHERE is_admin = 1")
-    admin_count = c.fetchone()[0]
-    conn.close()
-    
-    if admin_count == 0:
-        if not os.path.exists(PAGES_DIR):
-            os.makedirs(PAGES_DIR, exist_ok=True)
-        
-        homepage_content = '''+欢迎来到TxPyWiki
+# 初始页面，创建管理员时直接写入数据库
+_SEED_PAGES = {
+    "HomePage": '''+欢迎来到TxPyWiki
 
 这是一个基于TxPyWiki的Wiki系统。
 
@@ -2128,12 +2524,8 @@ name=示例表格
 
 ++帮助
 如需帮助，请查看(帮助页面)或联系管理员。
-'''
-        
-        with open(os.path.join(PAGES_DIR, "HomePage.3p"), 'w', encoding='utf-8') as f:
-            f.write(homepage_content)
-        
-        help_content = '''+帮助页面
+''',
+    "帮助页面": '''+帮助页面
 
 ++TxPyWiki语法
 [table
@@ -2179,12 +2571,11 @@ name=表格名称
 * `<code>` - 代码块
 * `<co>` - 可折叠内容
 * `<plantext>` - 纯文本，内部标签不会被解析
-'''
-        
-        with open(os.path.join(PAGES_DIR, "帮助页面.3p"), 'w', encoding='utf-8') as f:
-            f.write(help_content)
-        
-        template_content = '''<div class="info-box">
+''',
+}
+
+_SEED_TEMPLATES = {
+    "InfoBox": '''<div class="info-box">
     <h3><;title;></h3>
     <p><;content;></p>
     <small>创建于: <time></small>
@@ -2194,23 +2585,41 @@ name=表格名称
 使用 [InfoBox
 title=标题
 content=内容] 来调用此模板
-</doc>'''
+</doc>''',
+}
+
+def check_initial_setup():
+    with read_pool.cursor() as c:
+        c.execute("SELECT COUNT(*) FROM users WHERE is_admin = 1")
+        admin_count = c.fetchone()[0]
+    
+    if admin_count == 0:
+        if not os.path.exists(PAGES_DIR):
+            os.makedirs(PAGES_DIR, exist_ok=True)
         
-        with open(os.path.join(PAGES_DIR, "TEMPLATE.InfoBox.3p"), 'w', encoding='utf-8') as f:
-            f.write(template_content)
+        for name, content in _SEED_TEMPLATES.items():
+            with open(os.path.join(PAGES_DIR, f"TEMPLATE.{name}.3p"), 'w', encoding='utf-8') as f:
+                f.write(content)
         
         save_settings(DEFAULT_SETTINGS)
         
         return True
     return False
 
+# 管理员创建后不会再回到未初始化状态，之后的请求跳过检查
+_SETUP_DONE = False
+
 @app.before_request
 def setup_check():
+    global _SETUP_DONE
+    if _SETUP_DONE:
+        return
     if request.path == '/wiki/setup_admin' or request.path.startswith('/static/'):
         return
     
     if check_initial_setup():
         return redirect('/wiki/setup_admin')
+    _SETUP_DONE = True
 
 @app.route('/wiki/setup_admin', methods=['GET', 'POST'])
 def setup_admin():
@@ -2223,18 +2632,9 @@ def setup_admin():
             return "两次输入的密码不一致", 400
         
         if create_user(username, password, is_admin=True):
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            with open(os.path.join(PAGES_DIR, "HomePage.3p"), 'r', encoding='utf-8') as f:
-                content = f.read()
-            c.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user_id = c.fetchone()[0]
+            user_id = get_user(username)['id']
             
-            create_page("HomePage", content, user_id)
-            create_page("帮助页面", open(os.path.join(PAGES_DIR, "帮助页面.3p"), 'r', encoding='utf-8').read(), user_id)
-            
-            conn.close()
+            create_pages(_SEED_PAGES, user_id)
             
             session['user_id'] = user_id
             session['username'] = username
@@ -2244,43 +2644,16 @@ def setup_admin():
         
         return "创建管理员失败", 400
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>TxPyWiki 初始化</title>
-    ''' + BASE_CSS + '''
-    </head>
-    <body>
-        <div class="wiki-container">
-            <div class="form-container">
-                <h2>TxPyWiki 初始化设置</h2>
-                <p style="margin-bottom: 20px;">
-                    欢迎使用TxPyWiki！首先需要创建一个管理员账户。
-                </p>
-                <form method="post">
-                    <div class="form-group">
-                        <label>管理员用户名:</label>
-                        <input type="text" name="username" required>
-                    </div>
-                    <div class="form-group">
-                        <label>密码:</label>
-                        <input type="password" name="password" required>
-                    </div>
-                    <div class="form-group">
-                        <label>确认密码:</label>
-                        <input type="password" name="confirm_password" required>
-                    </div>
-                    <button type="submit" class="form-btn">创建管理员账户</button>
-                </form>
-            </div>
-        </div>
-    </body>
-    </html>
-    ''')
+    return render_template('setup_admin.html')
 
 if __name__ == '__main__':
     if not os.path.exists(DB_PATH):
         init_db()
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 调试模式只在设置了 TXPYWIKI_DEV 时开启；正式部署建议使用 gunicorn -w 1 --threads 8 main:app，
+    # 它通过 wsgi.file_wrapper 用 sendfile 发送上传的文件
+    # 只能开一个工作进程：会话密钥、权限缓存、统计计数和文件路径缓存都保存在进程内存中
+    debug = bool(os.environ.get('TXPYWIKI_DEV'))
+    if not debug:
+        print("提示: 正式部署建议使用 gunicorn -w 1 --threads 8 main:app (只能使用单个工作进程)")
+    app.run(host='0.0.0.0', port=5000, debug=debug, threaded=True)